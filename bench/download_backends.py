@@ -0,0 +1,153 @@
+"""
+Per-job overhead of the youtube-dl download backends.
+
+Serves a small media file over local HTTP and downloads it, or only fetches
+its info, with each backend, so the time is mostly the backend's own cost:
+an interpreter start per job for "subprocess", a thread hop for "library".
+
+$python3 -m bench.download_backends --jobs 20 --concurrency 4
+"""
+import argparse
+import asyncio
+import functools
+import os
+import resource
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from task.download_task import (
+    LibraryBackend,
+    Progress,
+    SubprocessBackend,
+    DownloadBackend,
+    YOUTUBE_DL,
+)
+
+TIMEOUT_S = 60
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class QuietServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address) -> None:
+        # youtube-dl closes connections early, e.g after probing the size.
+        pass
+
+
+def serve_file(root: str, size: int) -> ThreadingHTTPServer:
+    with open(f"{root}/media.webm", "wb") as file:
+        file.write(os.urandom(size))
+    handler = functools.partial(QuietHandler, directory=root)
+    server = QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run_jobs(
+    backend: DownloadBackend,
+    url: str,
+    out_dir: str,
+    jobs: int,
+    concurrency: int,
+    skip_download: bool,
+) -> List[float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def job(i: int) -> None:
+        output = None if skip_download else f"{out_dir}/{i}/%(id)s.%(ext)s"
+        async with semaphore:
+            start = time.perf_counter()
+            await backend.run(url, output, TIMEOUT_S, Progress(url))
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(job(i) for i in range(jobs)))
+    return latencies
+
+
+def peak_rss_mb(who: int) -> float:
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def memory(name: str, self_rss_mb: float) -> str:
+    """
+    Memory of the backend: the largest youtube-dl process for "subprocess",
+    and the growth of this process' peak RSS from `self_rss_mb`, taken
+    before the backends were made, for "library".
+    """
+    if name == "subprocess":
+        child_rss_mb = peak_rss_mb(resource.RUSAGE_CHILDREN)
+        return f"peak rss per child {child_rss_mb:.0f}MB"
+    growth_mb = peak_rss_mb(resource.RUSAGE_SELF) - self_rss_mb
+    return f"peak rss growth in process {growth_mb:.0f}MB"
+
+
+async def bench(args: argparse.Namespace) -> None:
+    root = tempfile.mkdtemp(prefix="bench_download_")
+    server = serve_file(root, args.size)
+    url = f"http://127.0.0.1:{server.server_address[1]}/media.webm"
+    self_rss_mb = peak_rss_mb(resource.RUSAGE_SELF)
+    backends = {
+        "subprocess": SubprocessBackend(args.youtube_dl),
+        "library": LibraryBackend(args.concurrency),
+    }
+    try:
+        for skip_download in (True, False):
+            mode = "info" if skip_download else "download"
+            for name, backend in backends.items():
+                # Warm up imports and connections.
+                await run_jobs(backend, url, root, 1, 1, skip_download)
+                start = time.perf_counter()
+                latencies = await run_jobs(
+                    backend,
+                    url,
+                    f"{root}/{name}",
+                    args.jobs,
+                    args.concurrency,
+                    skip_download,
+                )
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{mode:>8} {name:>10}: "
+                    f"mean {statistics.mean(latencies) * 1000:7.1f}ms "
+                    f"p50 {statistics.median(latencies) * 1000:7.1f}ms "
+                    f"max {max(latencies) * 1000:7.1f}ms "
+                    f"{args.jobs / elapsed * 60:7.1f} jobs/min "
+                    f"{memory(name, self_rss_mb)}"
+                )
+    finally:
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=256 * 1024,
+        help="Bytes of the served media file.",
+    )
+    parser.add_argument(
+        "--youtube-dl",
+        default=YOUTUBE_DL,
+        help="Command of the subprocess backend, e.g youtube-dl.",
+    )
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""
+End-to-end throughput of the single video worker against local fakes.
+
+Runs SingleVideoWorkflow.serve() on a seeded temporary SQLite DB, with a
+fake youtube-dl executable and a fake Whisper HTTP server in place of
+YouTube and OpenAI, both with configurable latency and media size. Each
+concurrency level sets every stage to that concurrency and runs on a fresh
+DB. Reports jobs/min, p50/p95/p99 claim latency (enqueued to claimed) and
+end-to-end latency (enqueued to done), and the time spent waiting for the
+writer connection.
+
+$python3 -m bench.throughput --jobs 100 --levels 1,4,16 --whisper-latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import statistics
+import stat
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Mapping, Sequence, Tuple
+
+import openai
+
+from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
+from lib.media_cache import MediaCache
+from lib.migration import migrate
+from lib.notifier import WorkNotifier
+from lib.whisper import WhisperClient
+from task.download_task import YOUTUBE_DL
+from workflow import single_video
+from workflow.single_video import Args, STAGE_CONCURRENCY, SingleVideoWorkflow
+from workflow.workflow import Status
+
+TIMEOUT_S = 10 * 60
+USER_CREDIT_M = 10 ** 9
+# Tables created from README.md, which lib/migration.py builds on.
+SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    create_at INTEGER,
+    auth_state TEXT,
+    credentials TEXT,
+    credit INTEGER
+);
+CREATE TABLE workflow (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    create_at INTEGER,
+    args TEXT,
+    type INTEGER,
+    status INTEGER
+);
+CREATE TABLE video (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    workflow_id INTEGER,
+    user_id INTEGER,
+    uuid TEXT,
+    snippt TEXT,
+    transcript TEXT
+);
+CREATE TABLE transcript (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content TEXT
+);
+CREATE TABLE payment (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    create_at INTEGER,
+    quantity INTEGER,
+    status INTEGER
+);
+"""
+# Prints yt-dlp's --print-json output and progress, and writes the media
+# file, after BENCH_YTDL_LATENCY_S.
+FAKE_YOUTUBE_DL = """#!{python}
+import json, os, sys, time
+
+args = sys.argv[1:]
+uuid = args[-1]
+time.sleep(float(os.environ["BENCH_YTDL_LATENCY_S"]))
+if "--skip-download" not in args:
+    path = args[args.index("--output") + 1]
+    path = path.replace("%(id)s", uuid).replace("%(ext)s", "webm")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(b"\\0" * int(os.environ["BENCH_MEDIA_BYTES"]))
+print(json.dumps({{
+    "id": uuid,
+    "title": f"Bench video {{uuid}}",
+    "description": "Bench video description",
+    "duration": int(os.environ["BENCH_DURATION_S"]),
+    "ext": "webm",
+}}), flush=True)
+# Like yt-dlp, progress only comes out of --print-json runs with --progress.
+if "--progress" in args and "--skip-download" not in args:
+    for percent in (0, 50, 100):
+        print(f"[download] {{percent:5.1f}}% of 1.00MiB", flush=True)
+"""
+
+
+class TimedLock(asyncio.Lock):
+    """
+    Lock which records how long each acquire() waited.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.waits: List[float] = []
+
+    async def acquire(self) -> bool:
+        start = time.perf_counter()
+        acquired = await super().acquire()
+        self.waits.append(time.perf_counter() - start)
+        return acquired
+
+
+def whisper_handler(
+    latency_s: float,
+    duration_s: int,
+) -> type:
+
+    class WhisperHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def do_POST(self) -> None:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency_s)
+            segments = [
+                {
+                    "id": i,
+                    "start": float(start),
+                    "end": float(min(start + 5, duration_s)),
+                    "text": f" Segment {i}.",
+                }
+                for i, start in enumerate(range(0, duration_s, 5))
+            ]
+            body = json.dumps({
+                "task": "transcribe",
+                "language": "english",
+                "duration": duration_s,
+                "text": " ".join(s["text"].strip() for s in segments),
+                "segments": segments,
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return WhisperHandler
+
+
+def serve_whisper(latency_s: float, duration_s: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), whisper_handler(latency_s, duration_s))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def install_youtube_dl(root: str, args: argparse.Namespace) -> None:
+    bin_dir = f"{root}/bin"
+    os.makedirs(bin_dir)
+    path = f"{bin_dir}/{YOUTUBE_DL}"
+    with open(path, "w") as file:
+        file.write(FAKE_YOUTUBE_DL.format(python=shutil.which("python3")))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ["BENCH_YTDL_LATENCY_S"] = str(args.ytdl_latency)
+    os.environ["BENCH_MEDIA_BYTES"] = str(args.size)
+    os.environ["BENCH_DURATION_S"] = str(args.duration)
+
+
+def seed_db(db_file: str) -> int:
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.executescript(SCHEMA)
+        cursor = conn.execute(
+            "INSERT INTO users (name, create_at, credit) VALUES (?, ?, ?)",
+            ("bench", int(time.time()), USER_CREDIT_M),
+        )
+        conn.commit()
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def percentiles(values: Sequence[float]) -> Tuple[float, float, float]:
+    if len(values) < 2:
+        value = values[0] if values else float("nan")
+        return value, value, value
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+def format_ms(values: Sequence[float]) -> str:
+    p50, p95, p99 = percentiles(values)
+    return f"{p50 * 1000:.0f}/{p95 * 1000:.0f}/{p99 * 1000:.0f}"
+
+
+class BenchWorkflow(SingleVideoWorkflow):
+    """
+    Records when each workflow is claimed and finished.
+    """
+
+    def __init__(self, concurrency: Mapping[str, int]):
+        super().__init__(concurrency)
+        self.enqueued_at: Dict[str, float] = {}
+        self.claimed_at: Dict[str, float] = {}
+        self.finished_at: Dict[str, float] = {}
+        self.statuses: Dict[str, Status] = {}
+        self._uuids: Dict[int, str] = {}
+        self.all_finished = asyncio.Event()
+
+    async def claim_batch(self, limit: int) -> List[Tuple[int, int, Args]]:
+        claims = await super().claim_batch(limit)
+        now = time.perf_counter()
+        for id, _, args in claims:
+            self._uuids[id] = args.video_uuid
+            self.claimed_at[args.video_uuid] = now
+        return claims
+
+    async def set_status(self, id: int, status: Status) -> None:
+        await super().set_status(id, status)
+        uuid = self._uuids.get(id)
+        if uuid is None:
+            return
+        self.finished_at[uuid] = time.perf_counter()
+        self.statuses[uuid] = status
+        if len(self.finished_at) == len(self.enqueued_at):
+            self.all_finished.set()
+
+
+async def enqueue(
+    workflow: BenchWorkflow,
+    user_id: int,
+    jobs: int,
+    rate: float,
+) -> None:
+    batch = []
+    for i in range(jobs):
+        uuid = f"bench{i:06d}"
+        batch.append(Args(
+            video_uuid=uuid,
+            auto_upload=False,
+            reuse_transcript=False,
+        ))
+        if rate > 0:
+            workflow.enqueued_at[uuid] = time.perf_counter()
+            await workflow.enqueue(user_id, batch)
+            batch = []
+            await asyncio.sleep(1 / rate)
+    if batch:
+        now = time.perf_counter()
+        for args in batch:
+            workflow.enqueued_at[args.video_uuid] = now
+        await workflow.enqueue(user_id, batch)
+
+
+async def run_level(
+    root: str,
+    level: int,
+    args: argparse.Namespace,
+) -> None:
+    level_dir = tempfile.mkdtemp(prefix=f"level{level}_", dir=root)
+    db_file = f"{level_dir}/bench.db"
+    user_id = seed_db(db_file)
+    manager = SQLiteConnectionManager()
+    manager._db_file = db_file
+    MediaCache._instance = None
+    MediaCache()._path = f"{level_dir}/media"
+    single_video.VIDEO_DOWNLOAD_PATH = f"{level_dir}/video"
+    WhisperClient._instance = None
+    await migrate()
+    lock = TimedLock()
+    manager._writer_lock = lock
+
+    workflow = BenchWorkflow({stage: level for stage in STAGE_CONCURRENCY})
+    # Jobs are counted up front, so the run can't look finished early.
+    workflow.enqueued_at = {f"bench{i:06d}": 0.0 for i in range(args.jobs)}
+    start = time.perf_counter()
+    serving = asyncio.create_task(
+        workflow.serve(single_video.MAX_SLEEP_SECONDS))
+    try:
+        await enqueue(workflow, user_id, args.jobs, args.rate)
+        await asyncio.wait_for(workflow.all_finished.wait(), args.timeout)
+    finally:
+        elapsed = time.perf_counter() - start
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+        await WorkNotifier().close()
+        await manager.close()
+
+    done = [
+        uuid for uuid, status in workflow.statuses.items()
+        if status == Status.DONE
+    ]
+    claim = [
+        workflow.claimed_at[uuid] - workflow.enqueued_at[uuid]
+        for uuid in workflow.claimed_at
+    ]
+    end_to_end = [
+        workflow.finished_at[uuid] - workflow.enqueued_at[uuid]
+        for uuid in done
+    ]
+    print(
+        f"concurrency {level:>3}: "
+        f"{len(done)}/{args.jobs} done "
+        f"{len(done) / elapsed * 60:8.1f} jobs/min "
+        f"claim p50/p95/p99 {format_ms(claim)}ms "
+        f"e2e p50/p95/p99 {format_ms(end_to_end)}ms "
+        f"db lock wait total {sum(lock.waits) * 1000:.0f}ms "
+        f"p99 {percentiles(lock.waits)[2] * 1000:.1f}ms "
+        f"over {len(lock.waits)} writes, "
+        f"whisper {dict(WhisperClient().stats())}"
+    )
+
+
+async def bench(args: argparse.Namespace) -> None:
+    root = tempfile.mkdtemp(prefix="bench_throughput_")
+    install_youtube_dl(root, args)
+    server = serve_whisper(args.whisper_latency, args.duration)
+    openai.api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    # The fake media isn't real audio for ffmpeg to transcode.
+    single_video.TRANSCODE_AUDIO = False
+    try:
+        for level in args.levels:
+            await run_level(root, level, args)
+    finally:
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--jobs", type=int, default=50)
+    parser.add_argument(
+        "--levels",
+        type=lambda levels: [int(level) for level in levels.split(",")],
+        default=[1, 4, 16],
+        help="Comma separated concurrency of every stage, e.g 1,4,16.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Jobs enqueued per second, or 0 to enqueue all at once.",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1024 * 1024,
+        help="Bytes of each downloaded media file.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=int,
+        default=5 * 60,
+        help="Seconds of each video.",
+    )
+    parser.add_argument(
+        "--ytdl-latency",
+        type=float,
+        default=0.2,
+        help="Seconds each youtube-dl run takes, besides its start up.",
+    )
+    parser.add_argument(
+        "--whisper-latency",
+        type=float,
+        default=1.0,
+        help="Seconds each Whisper request takes.",
+    )
+    parser.add_argument("--timeout", type=float, default=TIMEOUT_S)
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Keep the worker's INFO logs.",
+    )
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
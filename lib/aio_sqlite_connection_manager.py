@@ -1,47 +1,136 @@
+import asyncio
 import aiosqlite
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
 from lib.config import SQLITE_DB_FILE
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+# Max number of read-only connections kept open in one process.
+READER_POOL_SIZE = 4
+# Compiled statements cached per connection, keyed by the SQL string.
+CACHED_STATEMENTS = 256
+# Page cache per connection. Negative means KiB, i.e. 16MiB.
+CACHE_SIZE = -16 * 1024
+# How long to wait for a lock held by another process.
+BUSY_TIMEOUT_MS = 5 * 1000
+
+PRAGMAS = [
+    # Readers don't block the writer and the writer doesn't block readers.
+    "PRAGMA journal_mode = WAL",
+    # Only fsync on checkpoints. Still safe from corruption in WAL mode.
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = {CACHE_SIZE}",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store = MEMORY",
+]
 
 
 class SQLiteConnectionManager:
-    """"
+    """
+    Process-wide pool of persistent connections: up to READER_POOL_SIZE
+    read-only connections plus one writer connection shared under a lock.
+    Connections stay open between uses, so their statement caches are
+    reused. Call close() once on shutdown.
+
     Example 1:
-    try:
-        conn = await SQLiteConnectionManager().connect()
-        await conn.execute(...)
-    except Exception:
-        pass
-    finally:
-        await SQLiteConnectionManager().close()
+    async with SQLiteConnectionManager().reader() as conn:
+        async with conn.execute(...) as cursor:
+            row = await cursor.fetchone()
 
 
     Example 2:
-    async with SQLiteConnectionManager() as conn:
+    async with SQLiteConnectionManager().writer() as conn:
         await conn.execute(...)
+        await conn.commit()
     """
     _instance = None
 
     def __new__(cls) -> "SQLiteConnectionManager":
         if cls._instance is None:
             cls._instance = super().__new__(cls)
-            cls._instance._db_file = "db_file_to_be_set"
-            cls._instance._conn = None
+            cls._instance._db_file = SQLITE_DB_FILE
+            cls._instance._reset()
         return cls._instance
 
-    def __init__(self) -> "SQLiteConnectionManager":
-        self._db_file = SQLITE_DB_FILE
+    def _reset(self) -> None:
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle_readers: asyncio.Queue = asyncio.Queue()
+
+    async def connect(self) -> aiosqlite.Connection:
+        """
+        Open a dedicated connection outside of the pool, e.g. for per
+        connection state like `PRAGMA data_version`. The caller closes it.
+        """
+        return await self._open(readonly=True)
+
+    async def _open(self, readonly: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(
+            self._db_file,
+            cached_statements=CACHED_STATEMENTS,
+        )
+        try:
+            for pragma in PRAGMAS:
+                await conn.execute(pragma)
+            if readonly:
+                await conn.execute("PRAGMA query_only = ON")
+        except Exception:
+            await conn.close()
+            raise
+        logger.info(
+            f"Opened {'reader' if readonly else 'writer'} connection "
+            f"to {self._db_file}"
+        )
+        return conn
 
-    async def connect(self):
-        if self._conn is None:
-            self._conn = await aiosqlite.connect(self._db_file)
-        return self._conn
+    async def _acquire_reader(self) -> aiosqlite.Connection:
+        if (
+            self._idle_readers.empty()
+            and len(self._readers) < READER_POOL_SIZE
+        ):
+            # Reserve the slot before the await so the pool stays bounded.
+            self._readers.append(None)
+            try:
+                conn = await self._open(readonly=True)
+            finally:
+                self._readers.remove(None)
+            self._readers.append(conn)
+            return conn
+        return await self._idle_readers.get()
 
-    async def close(self):
-        if self._conn is not None:
-            await self._conn.close()
-            self._conn = None
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        conn = await self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                await conn.rollback()
+            self._idle_readers.put_nowait(conn)
 
-    async def __aenter__(self):
-        return await self.connect()
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        async with self._writer_lock:
+            if self._writer is None:
+                self._writer = await self._open(readonly=False)
+            try:
+                yield self._writer
+            finally:
+                # Whatever the caller didn't commit must not leak into the
+                # next transaction on the shared connection.
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.close()
+    async def close(self) -> None:
+        conns = [conn for conn in self._readers if conn is not None]
+        if self._writer is not None:
+            conns.append(self._writer)
+        for conn in conns:
+            await conn.close()
+        self._reset()
@@ -0,0 +1,170 @@
+import asyncio
+import re
+import shutil
+
+from typing import List, Tuple
+
+from lib.exception import DependencyException
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+FFMPEG = "ffmpeg"
+FFPROBE = "ffprobe"
+# Quieter than SILENCE_NOISE_DB for at least SILENCE_MIN_S counts as silence.
+SILENCE_NOISE_DB = -30
+SILENCE_MIN_S = 0.5
+# Shortest chunk plan_chunks() cuts, Whisper rejects audio under 0.1s.
+MIN_CHUNK_S = 1.0
+
+_SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+_SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+
+
+def has_ffmpeg() -> bool:
+    return all(shutil.which(cmd) for cmd in (FFMPEG, FFPROBE))
+
+
+async def run(cmd: List[str]) -> Tuple[bytes, bytes]:
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        msg = (
+            f"subprocess:\n ${' '.join(cmd)}\n"
+            f"Failed with return code: {process.returncode}\n"
+            f"stderror: {stderr[-2000:]}\n"
+        )
+        logger.error(msg)
+        raise DependencyException(msg)
+    return stdout, stderr
+
+
+async def probe_duration(path: str) -> float:
+    """
+    Duration of the media in seconds.
+    """
+    stdout, _ = await run([
+        FFPROBE,
+        "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        path,
+    ])
+    return float(stdout.decode().strip())
+
+
+async def detect_silences(
+    path: str,
+    duration: float,
+) -> List[Tuple[float, float]]:
+    """
+    (start, end) in seconds of every silence in the media.
+    """
+    _, stderr = await run([
+        FFMPEG,
+        "-hide_banner",
+        "-nostats",
+        "-i", path,
+        "-af", f"silencedetect=noise={SILENCE_NOISE_DB}dB:d={SILENCE_MIN_S}",
+        "-f", "null",
+        "-",
+    ])
+    silences = []
+    start = None
+    for line in stderr.decode(errors="replace").splitlines():
+        match = _SILENCE_START.search(line)
+        if match:
+            start = max(0.0, float(match.group(1)))
+            continue
+        match = _SILENCE_END.search(line)
+        if match and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    # Silence running until the end of the media has no silence_end.
+    if start is not None:
+        silences.append((start, duration))
+    return silences
+
+
+def plan_chunks(
+    duration: float,
+    silences: List[Tuple[float, float]],
+    max_chunk_s: float,
+) -> List[Tuple[float, float]]:
+    """
+    Split [0, duration] into (start, end) chunks no longer than
+    `max_chunk_s`. Each cut is at the middle of the latest silence in the
+    second half of the chunk, or right at `max_chunk_s` if there is none.
+    The last cut is moved back if it would leave less than MIN_CHUNK_S.
+    """
+    middles = sorted((start + end) / 2 for start, end in silences)
+    chunks = []
+    start = 0.0
+    while duration - start > max_chunk_s:
+        limit = start + max_chunk_s
+        candidates = [
+            middle for middle in middles
+            if start + max_chunk_s / 2 < middle <= limit
+        ]
+        cut = candidates[-1] if candidates else limit
+        chunks.append((start, cut))
+        start = cut
+    if chunks and duration - start < MIN_CHUNK_S:
+        previous, _ = chunks.pop()
+        start = duration - MIN_CHUNK_S
+        if start - previous < MIN_CHUNK_S:
+            start = previous
+        else:
+            chunks.append((previous, start))
+    chunks.append((start, duration))
+    return chunks
+
+
+async def cut(src: str, start: float, end: float, dst: str) -> str:
+    """
+    Copy the audio of `src` between `start` and `end` seconds to `dst`
+    without re-encoding.
+    """
+    await run([
+        FFMPEG,
+        "-hide_banner",
+        "-loglevel", "error",
+        "-y",
+        "-ss", f"{start:.3f}",
+        "-i", src,
+        "-t", f"{end - start:.3f}",
+        "-vn",
+        "-c:a", "copy",
+        dst,
+    ])
+    return dst
+
+
+async def transcode(src: str, dst: str, codec: str, bitrate: str) -> str:
+    """
+    Re-encode the audio of `src` to mono 16kHz, which is all Whisper uses.
+    """
+    await run([
+        FFMPEG,
+        "-hide_banner",
+        "-loglevel", "error",
+        "-y",
+        "-i", src,
+        "-vn",
+        "-ac", "1",
+        "-ar", "16000",
+        "-c:a", codec,
+        "-b:a", bitrate,
+        dst,
+    ])
+    return dst
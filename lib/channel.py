@@ -0,0 +1,122 @@
+import time
+
+from pydantic import BaseModel
+from typing import Optional
+
+from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+# Channel ids never change, but a title or handle may move to another
+# channel.
+CHANNEL_TTL_S = 7 * 24 * 60 * 60
+# Queries no channel was found for are retried after this long, in case
+# the channel is created or renamed.
+CHANNEL_MISS_TTL_S = 60 * 60
+
+
+class Channel(BaseModel):
+    """
+    Channel id resolved from a channel title, handle or id, or None if no
+    channel was found.
+    """
+    query: str
+    channel_id: Optional[str]
+    resolve_at: int = 0
+
+    @classmethod
+    async def find(
+        cls,
+        query: str,
+        ttl_s: int = CHANNEL_TTL_S,
+        miss_ttl_s: int = CHANNEL_MISS_TTL_S,
+    ) -> Optional["Channel"]:
+        sql = """
+            SELECT
+                channel_id, resolve_at
+            FROM channel
+            WHERE
+                query = ?
+                AND resolve_at > CASE
+                    WHEN channel_id IS NULL THEN ? ELSE ?
+                END
+        """
+        now = int(time.time())
+        async with SQLiteConnectionManager().reader() as conn:
+            async with conn.execute(
+                sql, (query, now - miss_ttl_s, now - ttl_s)
+            ) as cursor:
+                row = await cursor.fetchone()
+        if not row:
+            return None
+        channel_id, resolve_at = row
+        return Channel(
+            query=query,
+            channel_id=channel_id,
+            resolve_at=resolve_at,
+        )
+
+    async def save(self) -> None:
+        sql = """
+            INSERT OR REPLACE INTO
+                channel (query, channel_id, resolve_at)
+            VALUES (?, ?, ?)
+        """
+        self.resolve_at = int(time.time())
+        async with SQLiteConnectionManager().writer() as conn:
+            await conn.execute(
+                sql, (self.query, self.channel_id, self.resolve_at))
+            await conn.commit()
+
+
+class ChannelSync(BaseModel):
+    """
+    Watermark of a user's incremental sync of a channel: the publishedAt,
+    e.g "2023-09-10T10:00:45Z", of the newest video already synced.
+    """
+    channel_id: str
+    user_id: int
+    published_at: Optional[str] = None
+    sync_at: int = 0
+
+    @classmethod
+    async def find(cls, channel_id: str, user_id: int) -> "ChannelSync":
+        sql = """
+            SELECT
+                published_at, sync_at
+            FROM channel_sync
+            WHERE channel_id = ? AND user_id = ?
+        """
+        async with SQLiteConnectionManager().reader() as conn:
+            async with conn.execute(sql, (channel_id, user_id)) as cursor:
+                row = await cursor.fetchone()
+        if not row:
+            return ChannelSync(channel_id=channel_id, user_id=user_id)
+        published_at, sync_at = row
+        return ChannelSync(
+            channel_id=channel_id,
+            user_id=user_id,
+            published_at=published_at,
+            sync_at=sync_at,
+        )
+
+    async def save(self) -> None:
+        sql = """
+            INSERT OR REPLACE INTO
+                channel_sync (channel_id, user_id, published_at, sync_at)
+            VALUES (?, ?, ?, ?)
+        """
+        self.sync_at = int(time.time())
+        async with SQLiteConnectionManager().writer() as conn:
+            await conn.execute(
+                sql,
+                (
+                    self.channel_id,
+                    self.user_id,
+                    self.published_at,
+                    self.sync_at,
+                ),
+            )
+            await conn.commit()
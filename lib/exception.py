@@ -18,3 +18,7 @@ class DependencyException(Exception):
 
 class IOException(Exception):
     pass
+
+
+class QuotaExceededException(Exception):
+    pass
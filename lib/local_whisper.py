@@ -0,0 +1,239 @@
+import asyncio
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Mapping, Optional, Sequence, Tuple
+
+from lib.exception import DependencyException
+from lib.log import get_logger
+
+try:
+    import numpy
+    from faster_whisper import BatchedInferencePipeline, WhisperModel
+    from faster_whisper import decode_audio
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+except ImportError:
+    WhisperModel = None
+
+
+logger = get_logger(__file__)
+
+# https://github.com/SYSTRAN/faster-whisper#model-conversion
+MODEL_SIZE = "small"
+# int8 CTranslate2 weights, the fastest on CPU.
+COMPUTE_TYPE = "int8"
+# 0 lets CTranslate2 use every core.
+CPU_THREADS = 0
+SAMPLING_RATE = 16000
+# Speech is decoded in windows up to Whisper's input length.
+WINDOW_S = 30
+# Windows decoded in one forward pass, from any of the jobs in a batch.
+BATCH_SIZE = 16
+# A batch takes jobs queued with the same language, up to this many and
+# this much audio, which is held in memory while it runs.
+BATCH_JOBS = 8
+BATCH_MAX_S = 60 * 60
+
+
+class _Job:
+
+    def __init__(
+        self,
+        path: str,
+        language: Optional[str],
+        audio: Any,
+        # (start, end) samples of speech, each at most WINDOW_S long.
+        windows: Sequence[Tuple[int, int]],
+    ):
+        self.path = path
+        self.language = language
+        self.audio = audio
+        self.windows = windows
+        self.future: Optional[asyncio.Future] = None
+
+    @property
+    def duration_s(self) -> float:
+        return len(self.audio) / SAMPLING_RATE
+
+
+def plan_windows(
+    speech: Sequence[Mapping[str, int]],
+    max_samples: int,
+) -> List[Tuple[int, int]]:
+    """
+    Merge consecutive speech spans, in samples, into windows of at most
+    `max_samples`. Silence between merged spans is kept, so timestamps in a
+    window stay relative to its start.
+    """
+    windows = []
+    for span in speech:
+        if windows and span["end"] - windows[-1][0] <= max_samples:
+            windows[-1] = (windows[-1][0], span["end"])
+        else:
+            windows.append((span["start"], span["end"]))
+    return windows
+
+
+class LocalWhisper:
+    """
+    Whisper on the CPU of this machine with faster-whisper. The model is
+    loaded once per process, on the one thread which runs it.
+
+    Jobs queued while a batch runs are batched together: their audio is
+    concatenated and their speech windows are decoded BATCH_SIZE at a time,
+    so short videos fill batches they couldn't fill alone.
+
+    Example:
+    verbose_json = await LocalWhisper().transcribe(path, language=None)
+    """
+    _instance = None
+
+    def __new__(cls) -> "LocalWhisper":
+        if cls._instance is None:
+            if WhisperModel is None:
+                raise DependencyException(
+                    "LocalWhisper needs faster-whisper installed")
+            cls._instance = super().__new__(cls)
+            cls._instance._pipeline = None
+            cls._instance._executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="local-whisper",
+            )
+            cls._instance._pending = []
+            cls._instance._batcher = None
+            cls._instance.batches = 0
+            cls._instance.jobs = 0
+        return cls._instance
+
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            "batches": self.batches,
+            "jobs": self.jobs,
+            "pending": len(self._pending),
+        }
+
+    def _load(self) -> Any:
+        if self._pipeline is None:
+            logger.info(f"Loading {MODEL_SIZE} {COMPUTE_TYPE} Whisper model")
+            model = WhisperModel(
+                MODEL_SIZE,
+                device="cpu",
+                compute_type=COMPUTE_TYPE,
+                cpu_threads=CPU_THREADS,
+            )
+            self._pipeline = BatchedInferencePipeline(model=model)
+        return self._pipeline
+
+    def _prepare(self, path: str, language: Optional[str]) -> _Job:
+        audio = decode_audio(path, sampling_rate=SAMPLING_RATE)
+        speech = get_speech_timestamps(audio, VadOptions(
+            max_speech_duration_s=WINDOW_S,
+            min_silence_duration_ms=160,
+        ))
+        windows = plan_windows(speech, WINDOW_S * SAMPLING_RATE)
+        return _Job(path, language, audio, windows)
+
+    def _run_batch(
+        self,
+        jobs: Sequence[_Job],
+        language: Optional[str],
+    ) -> List[str]:
+        clips, offsets, offset = [], [], 0
+        for job in jobs:
+            offsets.append(offset)
+            for start, end in job.windows:
+                clips.append({
+                    "start": (offset + start) / SAMPLING_RATE,
+                    "end": (offset + end) / SAMPLING_RATE,
+                })
+            offset += len(job.audio)
+        # job index -> segments, in seconds from the start of the job.
+        job_segments = [[] for _ in jobs]
+        detected = language
+        if clips:
+            segments, info = self._load().transcribe(
+                numpy.concatenate([job.audio for job in jobs]),
+                language=language,
+                # Detect the language of each window, as jobs may differ.
+                multilingual=language is None,
+                clip_timestamps=clips,
+                batch_size=BATCH_SIZE,
+                without_timestamps=False,
+            )
+            detected = language or info.language
+            i = 0
+            for segment in segments:
+                start = segment.start * SAMPLING_RATE
+                while i + 1 < len(jobs) and start >= offsets[i + 1]:
+                    i += 1
+                job_offset_s = offsets[i] / SAMPLING_RATE
+                job_segments[i].append({
+                    "id": len(job_segments[i]),
+                    "seek": segment.seek,
+                    "start": round(segment.start - job_offset_s, 3),
+                    "end": round(segment.end - job_offset_s, 3),
+                    "text": segment.text,
+                    "tokens": segment.tokens,
+                    "temperature": segment.temperature,
+                    "avg_logprob": segment.avg_logprob,
+                    "compression_ratio": segment.compression_ratio,
+                    "no_speech_prob": segment.no_speech_prob,
+                })
+        return [
+            json.dumps({
+                "task": "transcribe",
+                "language": detected,
+                "duration": job.duration_s,
+                "text": " ".join(s["text"].strip() for s in segments),
+                "segments": segments,
+            }, ensure_ascii=False)
+            for job, segments in zip(jobs, job_segments)
+        ]
+
+    def _next_batch(self) -> Tuple[List[_Job], Optional[str]]:
+        language = self._pending[0].language
+        batch, duration_s = [], 0.0
+        for job in self._pending:
+            if job.language != language or len(batch) >= BATCH_JOBS:
+                continue
+            if batch and duration_s + job.duration_s > BATCH_MAX_S:
+                continue
+            batch.append(job)
+            duration_s += job.duration_s
+        self._pending = [job for job in self._pending if job not in batch]
+        return [job for job in batch if not job.future.done()], language
+
+    async def _drain(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch, language = self._next_batch()
+            if not batch:
+                continue
+            logger.info(
+                f"Transcribing {len(batch)} jobs in one batch, "
+                f"{len(self._pending)} still queued"
+            )
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._run_batch, batch, language)
+            except Exception as e:
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                continue
+            self.batches += 1
+            self.jobs += len(batch)
+            for job, result in zip(batch, results):
+                if not job.future.done():
+                    job.future.set_result(result)
+
+    async def transcribe(self, path: str, language: Optional[str]) -> str:
+        """
+        Transcript of the media at `path` as verbose_json.
+        """
+        job = await asyncio.to_thread(self._prepare, path, language)
+        job.future = asyncio.get_running_loop().create_future()
+        self._pending.append(job)
+        if self._batcher is None or self._batcher.done():
+            self._batcher = asyncio.create_task(self._drain())
+        return await job.future
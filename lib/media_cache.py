@@ -0,0 +1,270 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, Mapping, Optional, Tuple
+
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+# trunk-ignore(bandit/B108)
+MEDIA_CACHE_PATH = "/tmp/workflow/media"
+# Least recently used files are evicted to keep the cache under this size.
+MEDIA_CACHE_BYTES = 10 * 1024 * 1024 * 1024
+# Files used within this many seconds are never evicted, since another
+# worker process may be about to read them.
+MIN_AGE_S = 30 * 60
+# Format of the file as downloaded by youtube-dl.
+SOURCE = "source"
+
+Create = Callable[[], Awaitable[Optional[Tuple[str, Mapping[str, Any]]]]]
+
+
+class MediaEntry(BaseModel):
+    uuid: str
+    # SOURCE, or the format it was transcoded to, e.g "opus".
+    fmt: str
+    path: str
+    size: int
+    access_at: float
+    # e.g title, description and duration of the video.
+    meta: Mapping[str, Any] = {}
+
+
+class MediaCache:
+    """
+    Local files of downloaded and transcoded media, keyed by video uuid and
+    format, shared by all workflows and worker processes on the host. A
+    small SQLite index next to the files keeps their size and last access.
+
+    Files returned by get(), put() and get_or_create() are pinned and won't
+    be evicted by this process until release()-d. The index is only used
+    from worker threads, one at a time, to keep its IO off the event loop.
+
+    Example:
+    entry = await MediaCache().get_or_create(uuid, SOURCE, download)
+    try:
+        transcribe(entry.path)
+    finally:
+        MediaCache().release(entry.path)
+    """
+    _instance = None
+
+    def __new__(cls) -> "MediaCache":
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._path = MEDIA_CACHE_PATH
+            cls._instance._budget = MEDIA_CACHE_BYTES
+            cls._instance._conn = None
+            cls._instance._index_lock = threading.Lock()
+            cls._instance._pins = {}
+            cls._instance._pending = {}
+        return cls._instance
+
+    def _index(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self._path, exist_ok=True)
+            self._conn = sqlite3.connect(
+                f"{self._path}/index.sqlite",
+                check_same_thread=False,
+            )
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            # The index can be rebuilt, no need to fsync every access.
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.execute("PRAGMA busy_timeout = 5000")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS media (
+                    uuid TEXT,
+                    fmt TEXT,
+                    path TEXT,
+                    size INTEGER,
+                    access_at REAL,
+                    meta TEXT,
+                    PRIMARY KEY (uuid, fmt)
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS media_access_at "
+                "ON media (access_at)"
+            )
+        return self._conn
+
+    def _pin(self, path: str) -> None:
+        self._pins[path] = self._pins.get(path, 0) + 1
+
+    def release(self, path: Optional[str]) -> None:
+        if path not in self._pins:
+            return
+        self._pins[path] -= 1
+        if self._pins[path] <= 0:
+            del self._pins[path]
+
+    def _locked(self, fn: Callable[..., Any], *args: Any) -> Any:
+        with self._index_lock:
+            return fn(*args)
+
+    def _get(self, uuid: str, fmt: str) -> Optional[MediaEntry]:
+        conn = self._index()
+        row = conn.execute(
+            "SELECT path, size, meta FROM media WHERE uuid = ? AND fmt = ?",
+            (uuid, fmt),
+        ).fetchone()
+        if row is None:
+            return None
+        path, size, meta = row
+        if not os.path.exists(path):
+            conn.execute(
+                "DELETE FROM media WHERE uuid = ? AND fmt = ?", (uuid, fmt))
+            conn.commit()
+            return None
+        access_at = time.time()
+        conn.execute(
+            "UPDATE media SET access_at = ? WHERE uuid = ? AND fmt = ?",
+            (access_at, uuid, fmt),
+        )
+        conn.commit()
+        logger.info(f"Media cache hit for {uuid} {fmt}: {path}")
+        return MediaEntry(
+            uuid=uuid,
+            fmt=fmt,
+            path=path,
+            size=size,
+            access_at=access_at,
+            meta=json.loads(meta),
+        )
+
+    async def get(self, uuid: str, fmt: str) -> Optional[MediaEntry]:
+        entry = await asyncio.to_thread(self._locked, self._get, uuid, fmt)
+        if entry is not None:
+            self._pin(entry.path)
+        return entry
+
+    def _put(
+        self,
+        uuid: str,
+        fmt: str,
+        src: str,
+        meta: Mapping[str, Any],
+    ) -> MediaEntry:
+        os.makedirs(self._path, exist_ok=True)
+        ext = os.path.splitext(src)[1]
+        path = f"{self._path}/{uuid}.{fmt}{ext}"
+        os.replace(src, path)
+        entry = MediaEntry(
+            uuid=uuid,
+            fmt=fmt,
+            path=path,
+            size=os.path.getsize(path),
+            access_at=time.time(),
+            meta=meta,
+        )
+        conn = self._index()
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO
+                media (uuid, fmt, path, size, access_at, meta)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                entry.uuid,
+                entry.fmt,
+                entry.path,
+                entry.size,
+                entry.access_at,
+                json.dumps(entry.meta),
+            ),
+        )
+        conn.commit()
+        return entry
+
+    async def put(
+        self,
+        uuid: str,
+        fmt: str,
+        src: str,
+        meta: Mapping[str, Any],
+    ) -> MediaEntry:
+        """
+        Move the file at `src` into the cache.
+        """
+        entry = await asyncio.to_thread(
+            self._locked, self._put, uuid, fmt, src, meta)
+        self._pin(entry.path)
+        await self.evict()
+        return entry
+
+    async def get_or_create(
+        self,
+        uuid: str,
+        fmt: str,
+        create: Create,
+    ) -> Optional[MediaEntry]:
+        """
+        Return the cached file, or put() the (path, meta) from `create()`.
+        Concurrent calls for the same key in this process wait for the
+        first one instead of creating the file again. Returns None if
+        `create()` did.
+        """
+        key = (uuid, fmt)
+        while True:
+            entry = await self.get(uuid, fmt)
+            if entry is not None:
+                return entry
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            await asyncio.shield(pending)
+
+        self._pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            created = await create()
+            if created is None:
+                return None
+            path, meta = created
+            return await self.put(uuid, fmt, path, meta)
+        finally:
+            self._pending.pop(key).set_result(None)
+
+    def _evict(self) -> None:
+        conn = self._index()
+        (total,) = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM media").fetchone()
+        if total <= self._budget:
+            return
+        rows = conn.execute(
+            """
+            SELECT uuid, fmt, path, size
+            FROM media
+            WHERE access_at < ?
+            ORDER BY access_at
+            """,
+            (time.time() - MIN_AGE_S,),
+        ).fetchall()
+        for uuid, fmt, path, size in rows:
+            if total <= self._budget:
+                break
+            if path in self._pins:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            conn.execute(
+                "DELETE FROM media WHERE uuid = ? AND fmt = ?", (uuid, fmt))
+            total -= size
+            logger.info(f"Evicted {path} of {size} bytes from media cache")
+        conn.commit()
+        if total > self._budget:
+            logger.warning(
+                f"Media cache is {total} bytes, over its budget of "
+                f"{self._budget} bytes, with every file in use."
+            )
+
+    async def evict(self) -> None:
+        await asyncio.to_thread(self._locked, self._evict)
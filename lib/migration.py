@@ -0,0 +1,118 @@
+from typing import List, Tuple
+
+from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+
+# Schema changes on top of the tables created from README.md. Migration i
+# (0 based) brings the DB to version i + 1, tracked by `PRAGMA user_version`.
+# Only ever append to this list.
+MIGRATIONS: List[Tuple[str, ...]] = [
+    # 1: covering index for claiming the oldest TODO workflows of a type.
+    (
+        """
+        CREATE INDEX IF NOT EXISTS workflow_status_type_create_at
+        ON workflow (status, type, create_at)
+        """,
+    ),
+    # 2: key transcripts for reuse across users, see lib/transcript.py.
+    (
+        "ALTER TABLE transcript ADD COLUMN uuid TEXT",
+        "ALTER TABLE transcript ADD COLUMN language TEXT",
+        "ALTER TABLE transcript ADD COLUMN fmt TEXT",
+        "ALTER TABLE transcript ADD COLUMN prompt_hash TEXT",
+        "ALTER TABLE transcript ADD COLUMN create_at INTEGER",
+        """
+        CREATE INDEX IF NOT EXISTS transcript_uuid_language_fmt_prompt_hash
+        ON transcript (uuid, language, fmt, prompt_hash)
+        """,
+    ),
+    # 3: compressed transcript content, see lib/transcript.py. NULL for the
+    # plain text of older rows.
+    (
+        "ALTER TABLE transcript ADD COLUMN codec TEXT",
+    ),
+    # 4: channel ids resolved from channel titles, handles or ids, see
+    # lib/channel.py.
+    (
+        """
+        CREATE TABLE IF NOT EXISTS channel (
+            query TEXT PRIMARY KEY,
+            channel_id TEXT,
+            resolve_at INTEGER
+        )
+        """,
+    ),
+    # 5: publishedAt of the newest video synced from a channel for a user,
+    # see lib/channel.py.
+    (
+        """
+        CREATE TABLE IF NOT EXISTS channel_sync (
+            channel_id TEXT,
+            user_id INTEGER,
+            published_at TEXT,
+            sync_at INTEGER,
+            PRIMARY KEY (channel_id, user_id)
+        )
+        """,
+    ),
+    # 6: YouTube API quota units spent, see lib/quota.py.
+    (
+        """
+        CREATE TABLE IF NOT EXISTS quota_spend (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            at INTEGER,
+            method TEXT,
+            cost INTEGER,
+            priority INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS quota_spend_at ON quota_spend (at, cost)",
+    ),
+    # 7: video uuid of the args of each workflow, so channel fan-out skips
+    # videos the user already has a video workflow for. Not unique, since
+    # users may ask for the same video again, e.g in another language. See
+    # SingleVideoWorkflow.enqueue().
+    (
+        """
+        ALTER TABLE workflow ADD COLUMN video_uuid TEXT
+        GENERATED ALWAYS AS (json_extract(args, '$.video_uuid')) VIRTUAL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS workflow_user_id_video_uuid
+        ON workflow (user_id, video_uuid)
+        """,
+    ),
+    # 8: latest video by uuid or by workflow, see Video.find_snippet() and
+    # Video.load_transcript().
+    (
+        "CREATE INDEX IF NOT EXISTS video_uuid ON video (uuid)",
+        "CREATE INDEX IF NOT EXISTS video_workflow_id ON video (workflow_id)",
+    ),
+]
+
+
+async def migrate() -> int:
+    """
+    Apply pending migrations and return the schema version. Safe to call from
+    several workers at once, the version is re-read under a write lock.
+    """
+    async with SQLiteConnectionManager().writer() as conn:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            async with conn.execute("PRAGMA user_version") as cursor:
+                (version,) = await cursor.fetchone()
+            for i in range(version, len(MIGRATIONS)):
+                logger.info(f"Migrating DB to version: {i + 1}")
+                for sql in MIGRATIONS[i]:
+                    await conn.execute(sql)
+                await conn.execute(f"PRAGMA user_version = {i + 1}")
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            logger.exception(f"Failed to migrate DB with error: \n{e}")
+            raise e
+    return max(version, len(MIGRATIONS))
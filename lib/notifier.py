@@ -0,0 +1,88 @@
+import asyncio
+import aiosqlite
+
+from typing import Optional
+
+from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+# How often to check `PRAGMA data_version` while waiting.
+WATCH_INTERVAL_S = 0.25
+
+
+class WorkNotifier:
+    """
+    Process-wide wakeup for idle workers.
+
+    Code inserting TODO workflows in this process calls notify() to wake
+    waiters right away. Commits from other processes are noticed through
+    `PRAGMA data_version`, which changes whenever another connection
+    commits to the DB. Reading it only touches the WAL index in shared
+    memory, so watching it costs next to nothing while the worker is idle.
+
+    Example:
+    woken = await WorkNotifier().wait(timeout=6)
+    """
+    _instance = None
+
+    def __new__(cls) -> "WorkNotifier":
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._reset()
+        return cls._instance
+
+    def _reset(self) -> None:
+        self._event = asyncio.Event()
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._data_version: Optional[int] = None
+
+    def notify(self) -> None:
+        self._event.set()
+
+    async def _data_changed(self) -> bool:
+        if self._conn is None:
+            self._conn = await SQLiteConnectionManager().connect()
+        async with self._conn.execute("PRAGMA data_version") as cursor:
+            (data_version,) = await cursor.fetchone()
+        changed = (
+            self._data_version is not None
+            and data_version != self._data_version
+        )
+        self._data_version = data_version
+        return changed
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Return True as soon as new work may be available, or False once
+        `timeout` seconds passed without any sign of it.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            if self._event.is_set():
+                self._event.clear()
+                return True
+            try:
+                if await self._data_changed():
+                    return True
+            except Exception as e:
+                # Fall back to plain polling by the caller.
+                logger.warning(f"Failed to read data_version: {e}")
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(
+                    self._event.wait(),
+                    timeout=min(WATCH_INTERVAL_S, remaining),
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+        self._reset()
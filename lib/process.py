@@ -0,0 +1,92 @@
+import asyncio
+import os
+import signal
+
+from collections import deque
+from pydantic import BaseModel
+from typing import Callable, List, Optional
+
+from lib.exception import TimeoutException
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+# Longest single line read from a child, e.g youtube-dl's video info json.
+MAX_LINE_BYTES = 16 * 1024 * 1024
+# Lines of stderr kept for error messages.
+STDERR_TAIL_LINES = 50
+
+LineHandler = Callable[[str], None]
+
+
+class ProcessResult(BaseModel):
+    returncode: int
+    # Last STDERR_TAIL_LINES lines of stderr.
+    stderr: str
+
+
+def _kill_group(process: asyncio.subprocess.Process) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def _read_lines(stream: asyncio.StreamReader, handle: LineHandler):
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        handle(line.decode("utf-8", errors="replace").rstrip("\r\n"))
+
+
+async def supervise(
+    argv: List[str],
+    timeout: float,
+    on_stdout: LineHandler,
+    on_stderr: Optional[LineHandler] = None,
+) -> ProcessResult:
+    """
+    Run `argv` in its own process group and hand every line of its output to
+    the handlers as it arrives, instead of buffering all of it. On timeout
+    or cancellation the whole group, including grandchildren like ffmpeg,
+    is killed.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *argv,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+        limit=MAX_LINE_BYTES,
+    )
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+
+    def handle_stderr(line: str) -> None:
+        stderr_tail.append(line)
+        if on_stderr is not None:
+            on_stderr(line)
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                _read_lines(process.stdout, on_stdout),
+                _read_lines(process.stderr, handle_stderr),
+                process.wait(),
+            ),
+            timeout=timeout,
+        )
+    except asyncio.TimeoutError as e:
+        _kill_group(process)
+        await process.wait()
+        msg = f"Killed {argv[0]} after timeout of {timeout}s"
+        logger.error(msg)
+        raise TimeoutException(msg) from e
+    except BaseException:
+        _kill_group(process)
+        await process.wait()
+        raise
+    return ProcessResult(
+        returncode=process.returncode,
+        stderr="\n".join(stderr_tail),
+    )
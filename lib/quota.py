@@ -0,0 +1,173 @@
+import asyncio
+import time
+
+from enum import Enum
+from typing import Optional
+
+from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
+from lib.exception import QuotaExceededException
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+# https://developers.google.com/youtube/v3/determine_quota_cost
+COSTS = {
+    "captions.insert": 400,
+    "channels.list": 1,
+    "playlistItems.list": 1,
+    "search.list": 100,
+    "videos.list": 1,
+}
+DEFAULT_COST = 1
+DAY_S = 24 * 60 * 60
+# Units the project may spend per rolling day.
+DAILY_QUOTA = 10000
+# Units of the daily quota only HIGH priority calls may spend.
+HIGH_PRIORITY_RESERVE = 2000
+# Token bucket smoothing the spend of this process. It refills at the
+# daily quota spread over the day.
+BUCKET_CAPACITY = 1000
+BUCKET_REFILL_PER_S = DAILY_QUOTA / DAY_S
+# How often LOW priority calls re-check a spent daily quota.
+QUOTA_RETRY_S = 60
+
+
+class Priority(Enum):
+    # e.g channel polling, which can wait.
+    LOW = 1
+    # e.g caption uploads of finished transcripts.
+    HIGH = 2
+
+
+class QuotaBudget:
+    """
+    Shared YouTube API quota budget. Every call spends its unit cost from a
+    rolling day recorded in SQLite, so all worker processes see the same
+    spend.
+
+    LOW priority calls wait for the token bucket, in order, and for the
+    daily quota minus HIGH_PRIORITY_RESERVE. HIGH priority calls don't use
+    the bucket and may spend the reserve, but fail right away once the
+    daily quota is spent.
+
+    Example:
+    await QuotaBudget().acquire("search.list")
+    youtube.search().list(...).execute()
+    """
+    _instance = None
+
+    def __new__(cls) -> "QuotaBudget":
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._tokens = float(BUCKET_CAPACITY)
+            cls._instance._refill_at = time.monotonic()
+            cls._instance._bucket_lock = asyncio.Lock()
+        return cls._instance
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            BUCKET_CAPACITY,
+            self._tokens + (now - self._refill_at) * BUCKET_REFILL_PER_S,
+        )
+        self._refill_at = now
+
+    async def _take_tokens(self, cost: int, deadline: Optional[float]):
+        async with self._bucket_lock:
+            # Costs above the capacity only wait for a full bucket.
+            needed = min(cost, BUCKET_CAPACITY)
+            while True:
+                self._refill()
+                if self._tokens >= needed:
+                    self._tokens -= cost
+                    return
+                wait_s = (needed - self._tokens) / BUCKET_REFILL_PER_S
+                if deadline is not None and time.time() + wait_s > deadline:
+                    raise QuotaExceededException(
+                        f"Rate limited for {wait_s:.0f}s, past the deadline")
+                await asyncio.sleep(wait_s)
+
+    async def _spend(
+        self,
+        method: str,
+        cost: int,
+        priority: Priority,
+        limit: int,
+    ) -> bool:
+        now = int(time.time())
+        async with SQLiteConnectionManager().writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                async with conn.execute(
+                    "SELECT COALESCE(SUM(cost), 0) FROM quota_spend "
+                    "WHERE at > ?",
+                    (now - DAY_S,),
+                ) as cursor:
+                    (spent,) = await cursor.fetchone()
+                if spent + cost > limit:
+                    await conn.rollback()
+                    logger.warning(
+                        f"YouTube quota: {spent} of {limit} units spent in "
+                        f"the last day, {method} costs {cost}"
+                    )
+                    return False
+                await conn.execute(
+                    "INSERT INTO quota_spend (at, method, cost, priority) "
+                    "VALUES (?, ?, ?, ?)",
+                    (now, method, cost, priority.value),
+                )
+                await conn.execute(
+                    "DELETE FROM quota_spend WHERE at < ?",
+                    (now - 2 * DAY_S,),
+                )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        return True
+
+    async def spent(self) -> int:
+        """
+        Units spent in the last day.
+        """
+        async with SQLiteConnectionManager().reader() as conn:
+            async with conn.execute(
+                "SELECT COALESCE(SUM(cost), 0) FROM quota_spend WHERE at > ?",
+                (int(time.time()) - DAY_S,),
+            ) as cursor:
+                (spent,) = await cursor.fetchone()
+        return spent
+
+    async def acquire(
+        self,
+        method: str,
+        priority: Priority = Priority.LOW,
+        timeout_s: Optional[float] = None,
+    ) -> None:
+        """
+        Wait until `method`, e.g "search.list", fits in the budget and spend
+        its cost. Raises QuotaExceededException if it doesn't fit in
+        `timeout_s`, or at once for HIGH priority calls.
+        """
+        cost = COSTS.get(method, DEFAULT_COST)
+        deadline = None if timeout_s is None else time.time() + timeout_s
+        if priority == Priority.HIGH:
+            # Left out of the bucket, HIGH_PRIORITY_RESERVE already keeps
+            # their spend out of the way of LOW priority calls.
+            if not await self._spend(method, cost, priority, DAILY_QUOTA):
+                raise QuotaExceededException(
+                    f"Daily YouTube quota of {DAILY_QUOTA} units is spent, "
+                    f"can't call {method}"
+                )
+            return
+
+        await self._take_tokens(cost, deadline)
+        limit = DAILY_QUOTA - HIGH_PRIORITY_RESERVE
+        while not await self._spend(method, cost, priority, limit):
+            if deadline is not None and time.time() + QUOTA_RETRY_S > deadline:
+                raise QuotaExceededException(
+                    f"YouTube quota for LOW priority calls is spent, "
+                    f"can't call {method}"
+                )
+            await asyncio.sleep(QUOTA_RETRY_S)
@@ -0,0 +1,172 @@
+import json
+import re
+
+from pydantic import BaseModel
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
+
+# Whisper `response_format`s which can be stitched back together.
+SRT = "srt"
+VTT = "vtt"
+TEXT = "text"
+JSON = "json"
+VERBOSE_JSON = "verbose_json"
+# Formats render() makes out of one verbose_json transcript.
+FORMATS = (SRT, VTT, TEXT, JSON, VERBOSE_JSON)
+
+_TIMESTAMP = re.compile(r"(?:(\d+):)?(\d{1,2}):(\d{1,2})[,.](\d{1,3})")
+
+
+class Cue(BaseModel):
+    # Start and end in seconds from the beginning of the media.
+    start: float
+    end: float
+    text: str
+
+
+def parse_timestamp(timestamp: str) -> float:
+    """
+    "01:02:03,456" (srt), "01:02:03.456" or "02:03.456" (vtt) to seconds.
+    """
+    match = _TIMESTAMP.fullmatch(timestamp.strip())
+    if not match:
+        raise ValueError(f"Invalid timestamp: '{timestamp}'")
+    hours, minutes, seconds, millis = match.groups()
+    return (
+        int(hours or 0) * 3600
+        + int(minutes) * 60
+        + int(seconds)
+        + int(millis.ljust(3, "0")) / 1000
+    )
+
+
+def format_timestamp(seconds: float, separator: str) -> str:
+    millis = max(0, round(seconds * 1000))
+    hours, millis = divmod(millis, 3600 * 1000)
+    minutes, millis = divmod(millis, 60 * 1000)
+    seconds, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{millis:03d}"
+
+
+def parse_cues(content: str) -> List[Cue]:
+    """
+    Parse the cues of a srt or vtt transcript. Sequence numbers, the WEBVTT
+    header and cue settings are dropped.
+    """
+    cues = []
+    blocks = re.split(r"\n\s*\n", content.replace("\r\n", "\n").strip())
+    for block in blocks:
+        lines = block.split("\n")
+        for i, line in enumerate(lines):
+            if "-->" not in line:
+                continue
+            start, end = line.split("-->", 1)
+            # vtt cue settings follow the end timestamp, e.g "align:start".
+            end = end.strip().split(" ")[0]
+            cues.append(Cue(
+                start=parse_timestamp(start),
+                end=parse_timestamp(end),
+                text="\n".join(lines[i + 1:]).strip(),
+            ))
+            break
+    return cues
+
+
+def render_srt(cues: Sequence[Cue]) -> str:
+    return "".join(
+        f"{i}\n"
+        f"{format_timestamp(cue.start, ',')} --> "
+        f"{format_timestamp(cue.end, ',')}\n"
+        f"{cue.text}\n\n"
+        for i, cue in enumerate(cues, start=1)
+    )
+
+
+def render_vtt(cues: Sequence[Cue]) -> str:
+    return "WEBVTT\n\n" + "".join(
+        f"{format_timestamp(cue.start, '.')} --> "
+        f"{format_timestamp(cue.end, '.')}\n"
+        f"{cue.text}\n\n"
+        for cue in cues
+    )
+
+
+def segment_cues(verbose: Mapping[str, Any]) -> List[Cue]:
+    return [
+        Cue(
+            start=float(segment.get("start", 0)),
+            end=float(segment.get("end", 0)),
+            text=segment.get("text", "").strip(),
+        )
+        for segment in verbose.get("segments", [])
+    ]
+
+
+def render(fmt: str, verbose_json: str) -> str:
+    """
+    Render a verbose_json transcript as any of FORMATS, the same way Whisper
+    would have for that `response_format`.
+    """
+    if fmt == VERBOSE_JSON:
+        return verbose_json
+    verbose = json.loads(verbose_json)
+    if fmt == SRT:
+        return render_srt(segment_cues(verbose))
+    if fmt == VTT:
+        return render_vtt(segment_cues(verbose))
+    if fmt == TEXT:
+        return verbose.get("text", "").strip() + "\n"
+    if fmt == JSON:
+        return json.dumps(
+            {"text": verbose.get("text", "").strip()}, ensure_ascii=False)
+    raise ValueError(f"Can't render transcripts of format: {fmt}")
+
+
+def _stitch_verbose_json(parts: Sequence[Tuple[float, str]]) -> str:
+    stitched: Dict[str, Any] = {}
+    texts, segments, duration = [], [], 0.0
+    for offset, content in parts:
+        part = json.loads(content)
+        if not stitched:
+            stitched = dict(part)
+        texts.append(part.get("text", "").strip())
+        for segment in part.get("segments", []):
+            segment = dict(segment)
+            segment["id"] = len(segments)
+            segment["start"] = segment.get("start", 0) + offset
+            segment["end"] = segment.get("end", 0) + offset
+            segments.append(segment)
+        duration = offset + float(part.get("duration", 0))
+    stitched["text"] = " ".join(texts)
+    stitched["segments"] = segments
+    stitched["duration"] = duration
+    return json.dumps(stitched, ensure_ascii=False)
+
+
+def stitch(fmt: str, parts: Sequence[Tuple[float, str]]) -> str:
+    """
+    Join transcripts of consecutive chunks of one media file into one.
+    `parts` are (offset of the chunk in seconds, transcript of the chunk)
+    in media order. Timestamps are shifted by the chunk offset and
+    sequence numbers restart from 1.
+    """
+    if fmt in (SRT, VTT):
+        cues = []
+        for offset, content in parts:
+            for cue in parse_cues(content):
+                cue.start += offset
+                cue.end += offset
+                cues.append(cue)
+        return render_srt(cues) if fmt == SRT else render_vtt(cues)
+    if fmt == TEXT:
+        return "\n".join(content.strip() for _, content in parts) + "\n"
+    if fmt == JSON:
+        return json.dumps(
+            {"text": " ".join(
+                json.loads(content).get("text", "").strip()
+                for _, content in parts
+            )},
+            ensure_ascii=False,
+        )
+    if fmt == VERBOSE_JSON:
+        return _stitch_verbose_json(parts)
+    raise ValueError(f"Can't stitch transcripts of format: {fmt}")
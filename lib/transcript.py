@@ -0,0 +1,143 @@
+import hashlib
+import time
+import zlib
+
+from pydantic import BaseModel
+from typing import Optional, Tuple
+
+from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
+from lib.log import get_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = get_logger(__file__)
+
+UTF_8 = "utf-8"
+ZLIB = "zlib"
+ZSTD = "zstd"
+# Transcripts are written once and read rarely, so favor size over speed.
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+# Codec of new transcripts. Rows keep the codec they were written with.
+CODEC = ZSTD if zstandard is not None else ZLIB
+
+
+def prompt_hash(prompt: Optional[str]) -> str:
+    return hashlib.sha256((prompt or "").encode(UTF_8)).hexdigest()[:16]
+
+
+def compress(content: str) -> Tuple[str, bytes]:
+    data = content.encode(UTF_8)
+    if CODEC == ZSTD:
+        return ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return ZLIB, zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(codec: Optional[str], data: bytes) -> str:
+    if codec is None:
+        # plain text of rows from before compression.
+        return data
+    if codec == ZLIB:
+        return zlib.decompress(data).decode(UTF_8)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError(
+                "Transcript is zstd compressed but zstandard isn't installed")
+        return zstandard.ZstdDecompressor().decompress(data).decode(UTF_8)
+    raise ValueError(f"Unknown transcript codec: {codec}")
+
+
+class Transcript(BaseModel):
+    """
+    One transcript of a video in one format, shared by every user who
+    transcribed the same video with the same language and prompt. The
+    content is stored compressed with CODEC.
+    """
+    id: Optional[int] = None
+    uuid: str
+    # "" for auto-detected language.
+    language: str = ""
+    fmt: str
+    prompt_hash: str
+    content: str
+
+    @classmethod
+    async def find(
+        cls,
+        uuid: str,
+        language: Optional[str],
+        fmt: str,
+        prompt_hash: str,
+    ) -> Optional["Transcript"]:
+        sql = """
+            SELECT
+                id, codec, content
+            FROM transcript
+            WHERE uuid = ? AND language = ? AND fmt = ? AND prompt_hash = ?
+            ORDER BY id DESC
+            LIMIT 1
+        """
+        language = language or ""
+        async with SQLiteConnectionManager().reader() as conn:
+            async with conn.execute(
+                sql, (uuid, language, fmt, prompt_hash)
+            ) as cursor:
+                row = await cursor.fetchone()
+        if not row:
+            return None
+        id, codec, content = row
+        return Transcript(
+            id=id,
+            uuid=uuid,
+            language=language,
+            fmt=fmt,
+            prompt_hash=prompt_hash,
+            content=decompress(codec, content),
+        )
+
+    @classmethod
+    async def content_by_id(cls, id: int) -> Optional[str]:
+        sql = """
+            SELECT
+                codec, content
+            FROM transcript
+            WHERE id = ?
+        """
+        async with SQLiteConnectionManager().reader() as conn:
+            async with conn.execute(sql, (id,)) as cursor:
+                row = await cursor.fetchone()
+        if not row:
+            return None
+        codec, content = row
+        return decompress(codec, content)
+
+    async def save(self) -> int:
+        sql = """
+            INSERT INTO
+                transcript (
+                    uuid, language, fmt, prompt_hash, codec, content, create_at
+                )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """
+        codec, content = compress(self.content)
+        async with SQLiteConnectionManager().writer() as conn:
+            cursor = await conn.execute(
+                sql,
+                (
+                    self.uuid,
+                    self.language,
+                    self.fmt,
+                    self.prompt_hash,
+                    codec,
+                    content,
+                    int(time.time()),
+                ),
+            )
+            self.id = cursor.lastrowid
+            await cursor.close()
+            await conn.commit()
+        return self.id
@@ -1,20 +1,104 @@
+import asyncio
 import json
+import time
 
 from cryptography.fernet import Fernet
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from pydantic import BaseModel
 
-from typing import Optional
+from typing import Optional, Tuple
 
 from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
 from lib.log import get_logger
 from lib.config import FERNET_KEY
 
 UTF_8 = "utf-8"
+# Decrypted credentials are kept this long, or until invalidated.
+CREDENTIALS_TTL_S = 30 * 60
 
 logger = get_logger(__file__)
 
 
+class CredentialsCache:
+    """
+    Decrypted credentials per user, so repeated uploads skip the Fernet
+    decryption and parsing. get() only serves an entry for the same
+    encrypted credentials it was decrypted from, so a user re-authorizing
+    never gets stale ones. Encrypted credentials are ordered by their Fernet
+    timestamp, and an entry is never replaced by older ones, e.g from a
+    User loaded before a refresh.
+    """
+    _instance = None
+
+    def __new__(cls) -> "CredentialsCache":
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._fernet = Fernet(FERNET_KEY)
+            # user id -> (encrypted credentials, credentials, cached at)
+            cls._instance._entries = {}
+            cls._instance._locks = {}
+        return cls._instance
+
+    def _encrypted_at(self, encrypted: str) -> int:
+        return self._fernet.extract_timestamp(encrypted)
+
+    def _decrypt(self, user_id: int, encrypted: str) -> Credentials:
+        credentials_json = json.loads(
+            self._fernet.decrypt(encrypted).decode(UTF_8))
+        credentials = Credentials.from_authorized_user_info(
+            info=credentials_json)
+        entry = self._entries.get(user_id)
+        if (
+            entry is None
+            or entry[0] == encrypted
+            or self._encrypted_at(encrypted) > self._encrypted_at(entry[0])
+        ):
+            self.put(user_id, encrypted, credentials)
+        return credentials
+
+    def get(self, user_id: int, encrypted: str) -> Credentials:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            cached_encrypted, credentials, cached_at = entry
+            if (
+                cached_encrypted == encrypted
+                and time.time() - cached_at < CREDENTIALS_TTL_S
+            ):
+                return credentials
+        return self._decrypt(user_id, encrypted)
+
+    def latest(self, user_id: int, encrypted: str) -> Tuple[str, Credentials]:
+        """
+        The newest of `encrypted` and the cached encrypted credentials of the
+        user, with its credentials.
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] != encrypted and (
+            self._encrypted_at(entry[0]) >= self._encrypted_at(encrypted)
+        ):
+            encrypted = entry[0]
+        return encrypted, self.get(user_id, encrypted)
+
+    def put(
+        self,
+        user_id: int,
+        encrypted: str,
+        credentials: Credentials,
+    ) -> None:
+        self._entries[user_id] = (encrypted, credentials, time.time())
+
+    def encrypt(self, credentials: Credentials) -> str:
+        return self._fernet.encrypt(
+            credentials.to_json().encode(UTF_8)).decode(UTF_8)
+
+    def invalidate(self, user_id: int) -> None:
+        self._entries.pop(user_id, None)
+
+    def lock(self, user_id: int) -> asyncio.Lock:
+        return self._locks.setdefault(user_id, asyncio.Lock())
+
+
 class User(BaseModel):
     id: int
     name: str
@@ -27,23 +111,56 @@ class User(BaseModel):
         # decrypt
         if not self.credentials_encrypted:
             return None
-        fernet = Fernet(FERNET_KEY)
-        credentials_raw = fernet.decrypt(
-            self.credentials_encrypted
-        ).decode(UTF_8)
-        credentials_json = json.loads(credentials_raw)
-        logger.info(f"credentials_json\n {credentials_json}")
-        return Credentials.from_authorized_user_info(info=credentials_json)
+        return CredentialsCache().get(self.id, self.credentials_encrypted)
 
     @credentials.setter
     def credentials(self, credentials: Optional[Credentials]) -> None:
         # encrypt
         if not credentials:
             return None
-        fernet = Fernet(FERNET_KEY)
-        self.credentials_encrypted = fernet.encrypt(
-            credentials.to_json().encode(UTF_8)
-        )
+        cache = CredentialsCache()
+        self.credentials_encrypted = cache.encrypt(credentials)
+        cache.put(self.id, self.credentials_encrypted, credentials)
+
+    async def fresh_credentials(self) -> Optional[Credentials]:
+        """
+        Credentials with an unexpired access token. An expired one is
+        refreshed once for all concurrent callers and saved back encrypted.
+        """
+        cache = CredentialsCache()
+        async with cache.lock(self.id):
+            if not self.credentials_encrypted:
+                return None
+            # Another caller may have refreshed them since this user loaded.
+            self.credentials_encrypted, credentials = cache.latest(
+                self.id, self.credentials_encrypted)
+            if credentials.valid:
+                return credentials
+            if not credentials.refresh_token:
+                logger.warning(
+                    f"Credentials of user {self.id} expired "
+                    "without a refresh token."
+                )
+                return credentials
+            logger.info(f"Refreshing credentials of user {self.id}")
+            try:
+                await asyncio.to_thread(credentials.refresh, Request())
+            except Exception:
+                cache.invalidate(self.id)
+                raise
+            self.credentials = credentials
+            await self.save_credentials()
+            return credentials
+
+    async def save_credentials(self) -> None:
+        sql = """
+            UPDATE users
+            SET credentials = ?
+            WHERE id = ?
+        """
+        async with SQLiteConnectionManager().writer() as conn:
+            await conn.execute(sql, (self.credentials_encrypted, self.id))
+            await conn.commit()
 
     @classmethod
     async def get_by_id(cls, id: int) -> "User":
@@ -55,9 +172,9 @@ class User(BaseModel):
         """
         user = None
         try:
-            async with SQLiteConnectionManager() as conn:
-                cursor = await conn.execute(sql, (id,))
-                row = await cursor.fetchone()
+            async with SQLiteConnectionManager().reader() as conn:
+                async with conn.execute(sql, (id,)) as cursor:
+                    row = await cursor.fetchone()
                 if row:
                     id, name, create_at, credentials_encrypted, credit = row
                     user = User(
@@ -80,7 +197,7 @@ class User(BaseModel):
         """
 
         try:
-            async with SQLiteConnectionManager() as conn:
+            async with SQLiteConnectionManager().writer() as conn:
                 await conn.execute(sql, (cost, self.id))
                 await conn.commit()
         except Exception as e:
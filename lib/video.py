@@ -1,25 +1,38 @@
+import asyncio
 import json
 import os
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from typing import Mapping, Any, Optional
-from lib.config import (
-    YOUTUBE_API_KEY,
-    API_VERSION,
-)
+from googleapiclient.http import MediaFileUpload
+from typing import Dict, Mapping, Any, Optional
 from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
 from lib.log import get_logger
+from lib.quota import Priority, QuotaBudget
+from lib.transcript import Transcript
+from lib.youtube import YouTubeClients
 from pydantic import BaseModel
 
 # trunk-ignore(bandit/B108)
 VIDEO_TRANSCRIPT_PATH = "/tmp/workflow/transcript"
 UTF_8 = "utf-8"
+# Caption uploads block on HTTP, so they run on their own threads.
+UPLOAD_WORKERS = 4
+# Resumable upload chunk, a multiple of 256KiB.
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Retries of each chunk on 5xx, 429 and connection errors, with exponential
+# backoff.
+UPLOAD_RETRIES = 5
 
 
 logger = get_logger(__file__)
 
+_upload_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_WORKERS,
+    thread_name_prefix="caption-upload",
+)
+
 
 def now() -> int:
     return int(time.time())
@@ -33,6 +46,8 @@ class Video(BaseModel):
     snippet: Mapping[str, Any] = {}
     # format -> raw transcript
     transcript: Mapping[str, Any] = {}
+    # format -> id of the saved transcript, which is what save() stores.
+    transcript_ids: Dict[str, int] = {}
     # path to he downloaded video.
     path: Optional[str] = None
 
@@ -61,18 +76,80 @@ class Video(BaseModel):
             self.snippet[k] = v
 
     def set_srt(self, transcript: str) -> None:
-        self.transcript["srt"] = transcript
+        self.set_transcript("srt", transcript)
+
+    def set_transcript(self, fmt: str, transcript: str) -> None:
+        self.transcript[fmt] = transcript
+
+    def set_transcript_id(self, fmt: str, id: int) -> None:
+        self.transcript_ids[fmt] = id
+
+    @classmethod
+    async def load_transcript(
+        cls,
+        workflow_id: int,
+        fmt: str,
+    ) -> Optional[str]:
+        """
+        Transcript of the video saved by the workflow in one format. Only
+        that format is read from the transcript table and decompressed.
+        """
+        sql = """
+            SELECT
+                transcript
+            FROM video
+            WHERE workflow_id = ?
+            ORDER BY id DESC
+            LIMIT 1
+        """
+        async with SQLiteConnectionManager().reader() as conn:
+            async with conn.execute(sql, (workflow_id,)) as cursor:
+                row = await cursor.fetchone()
+        if not row or not row[0]:
+            return None
+        transcript = json.loads(row[0]).get(fmt, None)
+        if isinstance(transcript, int):
+            return await Transcript.content_by_id(transcript)
+        # raw transcript of videos saved before transcript ids.
+        return transcript
+
+    @classmethod
+    async def find_snippet(cls, uuid: str) -> Optional[Mapping[str, Any]]:
+        """
+        Snippet of the latest saved video with this uuid, by any user.
+        """
+        sql = """
+            SELECT
+                snippt
+            FROM video
+            WHERE uuid = ?
+            ORDER BY id DESC
+            LIMIT 1
+        """
+        async with SQLiteConnectionManager().reader() as conn:
+            async with conn.execute(sql, (uuid,)) as cursor:
+                row = await cursor.fetchone()
+        if not row or not row[0]:
+            return None
+        return json.loads(row[0])
 
     async def save(self) -> None:
         """
-        Save video to database
+        Save video to database, with the ids of its transcripts which must
+        have been saved already.
         """
+        missing = self.transcript.keys() - self.transcript_ids.keys()
+        if missing:
+            logger.warning(
+                f"Transcripts {missing} of video {self.uuid} from workflow "
+                f"{self.workflow_id} aren't saved and won't be referenced."
+            )
         sql = """
             INSERT INTO
                 video (workflow_id, user_id, uuid, snippt, transcript)
             VALUES (?, ?, ?, ?, ?)
         """
-        async with SQLiteConnectionManager() as conn:
+        async with SQLiteConnectionManager().writer() as conn:
             await conn.execute(
                 sql,
                 (
@@ -80,7 +157,7 @@ class Video(BaseModel):
                     self.user_id,
                     self.uuid,
                     json.dumps(self.snippet),
-                    json.dumps(self.transcript),
+                    json.dumps(self.transcript_ids),
                 )
             )
             await conn.commit()
@@ -103,28 +180,59 @@ class Video(BaseModel):
             transcript_path: str,
             credentials: Credentials
     ) -> Any:
-        youtube = build(
-            "youtube",
-            API_VERSION,
-            developerKey=YOUTUBE_API_KEY,
-            credentials=credentials,
+        """
+        Upload on the upload thread pool, leaving the event loop free for
+        other workflows.
+        """
+        await QuotaBudget().acquire("captions.insert", Priority.HIGH)
+        result = await asyncio.get_running_loop().run_in_executor(
+            _upload_executor,
+            self._upload_transcript,
+            language,
+            transcript_path,
+            credentials,
         )
+
+        logger.info(result)
+
+        return result
+
+    def _upload_transcript(
+            self,
+            language: str,
+            transcript_path: str,
+            credentials: Credentials
+    ) -> Any:
+        clients = YouTubeClients()
+        youtube = clients.user_client(self.user_id, credentials)
         # This require at last one of them:
         # https://www.googleapis.com/auth/youtube.force-ssl
         # https://www.googleapis.com/auth/youtubepartner
-        result = youtube.captions().insert(
+        request = youtube.captions().insert(
             part="snippet",
             body=dict(
                 snippet=dict(
                     videoId=self.uuid,
                     language=language,
-                    name=f"autocap_{language if language else ''}_{now}",
+                    name=f"autocap_{language if language else ''}_{now()}",
                     isDraft=False
                 )
             ),
-            media_body=transcript_path,
-        ).execute()
-
-        logger.info(result)
-
+            media_body=MediaFileUpload(
+                transcript_path,
+                mimetype="application/octet-stream",
+                chunksize=UPLOAD_CHUNK_BYTES,
+                resumable=True,
+            ),
+        )
+        http = clients.thread_http(credentials)
+        result = None
+        while result is None:
+            status, result = request.next_chunk(
+                http=http, num_retries=UPLOAD_RETRIES)
+            if status is not None:
+                logger.info(
+                    f"Uploaded {int(status.progress() * 100)}% of "
+                    f"{transcript_path} for video {self.uuid}"
+                )
         return result
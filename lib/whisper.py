@@ -0,0 +1,196 @@
+import asyncio
+import random
+
+import openai
+
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Mapping, Optional
+
+from lib.config import OPENAI_API_KEY
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+MODEL = "whisper-1"
+# AIMD concurrency limit of Whisper requests in this process.
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+MAX_LIMIT = 32
+# Each request is cancelled after this long.
+REQUEST_TIMEOUT_S = 10 * 60
+MAX_RETRIES = 5
+# Full jitter exponential backoff, see
+# https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+BACKOFF_BASE_S = 1
+BACKOFF_MAX_S = 60
+
+# Signs of running above the rate the API can take, which halve the limit.
+OVERLOAD_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    asyncio.TimeoutError,
+)
+# Worth retrying, the rest e.g InvalidRequestError won't change.
+RETRY_ERRORS = OVERLOAD_ERRORS + (
+    # other 5xx
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.TryAgain,
+)
+
+
+class Slot:
+
+    def __init__(self, saturated: bool, generation: int):
+        # Whether this took the last free slot, i.e. the limit was reached.
+        self.saturated = saturated
+        # Decreases of the limit before this slot was taken.
+        self.generation = generation
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit which grows by one for each limit's worth of
+    successful requests made at the limit, and halves on overload, i.e AIMD.
+    It halves once per overload: failures of requests which started before
+    the last decrease are part of the same one.
+    """
+
+    def __init__(
+        self,
+        initial: int = INITIAL_LIMIT,
+        min_limit: int = MIN_LIMIT,
+        max_limit: int = MAX_LIMIT,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.generation = 0
+        self._changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[Slot]:
+        """
+        Hold one of the slots, for increase() or decrease() by its request.
+        """
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            slot = Slot(
+                saturated=self.in_flight >= int(self.limit),
+                generation=self.generation,
+            )
+        try:
+            yield slot
+        finally:
+            async with self._changed:
+                self.in_flight -= 1
+                self._changed.notify_all()
+
+    async def increase(self, slot: Slot) -> None:
+        # Successes below the limit say nothing about a higher one.
+        if not slot.saturated:
+            return
+        async with self._changed:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._changed.notify_all()
+
+    async def decrease(self, slot: Slot) -> None:
+        async with self._changed:
+            if slot.generation != self.generation:
+                return
+            self.generation += 1
+            self.limit = max(self.min_limit, self.limit / 2)
+
+
+def retry_after_s(e: Exception) -> Optional[float]:
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class WhisperClient:
+    """
+    Whisper API calls under an adaptive concurrency limit, with retries and
+    per-request timeouts, so the worker runs near the highest rate the API
+    allows without failing workflows on 429s.
+
+    Example:
+    transcript = await WhisperClient().transcribe(
+        path, prompt=prompt, response_format="srt", language=None)
+    """
+    _instance = None
+
+    def __new__(cls) -> "WhisperClient":
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.limit = AdaptiveLimit()
+            cls._instance.retries = 0
+            cls._instance.rate_limited = 0
+            cls._instance.timeouts = 0
+        return cls._instance
+
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            "limit": round(self.limit.limit, 2),
+            "in_flight": self.limit.in_flight,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "timeouts": self.timeouts,
+        }
+
+    async def _transcribe_once(self, path: str, **kwargs: Any) -> Any:
+        async with self.limit.slot() as slot:
+            try:
+                with open(path, "rb") as file:
+                    transcript = await asyncio.wait_for(
+                        openai.Audio.atranscribe(
+                            model=MODEL,
+                            file=file,
+                            api_key=OPENAI_API_KEY,
+                            **kwargs,
+                        ),
+                        timeout=REQUEST_TIMEOUT_S,
+                    )
+            except OVERLOAD_ERRORS:
+                await self.limit.decrease(slot)
+                raise
+            await self.limit.increase(slot)
+        return transcript
+
+    async def transcribe(self, path: str, **kwargs: Any) -> Any:
+        """
+        openai.Audio.atranscribe the file at `path` with `kwargs`.
+        """
+        attempt = 0
+        while True:
+            try:
+                transcript = await self._transcribe_once(path, **kwargs)
+            except RETRY_ERRORS as e:
+                if isinstance(e, openai.error.RateLimitError):
+                    self.rate_limited += 1
+                if isinstance(e, (asyncio.TimeoutError, openai.error.Timeout)):
+                    self.timeouts += 1
+                if attempt >= MAX_RETRIES:
+                    raise
+                backoff_s = random.uniform(
+                    0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt))
+                retry_after = retry_after_s(e)
+                if retry_after is not None:
+                    backoff_s += retry_after
+                attempt += 1
+                self.retries += 1
+                logger.warning(
+                    f"Whisper request for {path} failed with "
+                    f"{type(e).__name__}: {e}. Retry {attempt} in "
+                    f"{backoff_s:.1f}s, {self.stats()}"
+                )
+                await asyncio.sleep(backoff_s)
+                continue
+            return transcript
@@ -0,0 +1,201 @@
+import json
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import httplib2
+
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import Resource, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from typing import Any, Mapping, Optional, Tuple
+
+from lib.config import YOUTUBE_API_KEY, API_VERSION
+from lib.exception import DependencyException
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+API_SERVICE_NAME = "youtube"
+DISCOVERY_URL = (
+    "https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest")
+# trunk-ignore(bandit/B108)
+DISCOVERY_CACHE_PATH = "/tmp/workflow/discovery"
+HTTP_TIMEOUT_S = 60
+# Responses kept by ETagCache for conditional requests.
+ETAG_CACHE_ENTRIES = 1024
+
+
+class ETagCache:
+    """
+    Wraps an httplib2.Http to make GET requests conditional on the ETag of
+    the last response to the same URL. A 304 Not Modified is answered with
+    the cached response, so unchanged results cost no bandwidth or parsing
+    of a new body.
+
+    Only for clients without per-user auth, since the URL is the key.
+    """
+
+    def __init__(self, http: httplib2.Http, entries: int = ETAG_CACHE_ENTRIES):
+        self.http = http
+        self.entries = entries
+        # uri -> (etag, response, content), least recently used first.
+        self._responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.http, name)
+
+    def request(
+        self,
+        uri: str,
+        method: str = "GET",
+        body: Optional[str] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        **kwargs: Any,
+    ) -> Tuple[httplib2.Response, bytes]:
+        if method != "GET":
+            return self.http.request(uri, method, body, headers, **kwargs)
+        headers = dict(headers or {})
+        cached = self._responses.get(uri)
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+        rsp, content = self.http.request(uri, method, body, headers, **kwargs)
+        if rsp.status == 304 and cached is not None:
+            self.hits += 1
+            self._responses.move_to_end(uri)
+            _, cached_rsp, cached_content = cached
+            return httplib2.Response(dict(cached_rsp)), cached_content
+        self.misses += 1
+        etag = rsp.get("etag")
+        if rsp.status == 200 and etag:
+            self._responses[uri] = (etag, dict(rsp), content)
+            self._responses.move_to_end(uri)
+            while len(self._responses) > self.entries:
+                self._responses.popitem(last=False)
+        return rsp, content
+
+    def stats(self) -> Mapping[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._responses),
+        }
+
+
+class YouTubeClients:
+    """
+    YouTube API clients built from a discovery document cached on disk: one
+    with the API key, and one authorized client per user. Clients are kept
+    for the life of the process, so their HTTP connections are reused.
+
+    Example:
+    youtube = YouTubeClients().user_client(user.id, credentials)
+    youtube.captions().insert(...).execute()
+    """
+    _instance = None
+
+    def __new__(cls) -> "YouTubeClients":
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._document = None
+            cls._instance._document_lock = threading.Lock()
+            cls._instance._api_key_client = None
+            cls._instance.etag_cache = None
+            # user id -> (credentials, client)
+            cls._instance._user_clients = {}
+            cls._instance._local = threading.local()
+        return cls._instance
+
+    def document(self) -> Mapping[str, Any]:
+        if self._document is None:
+            with self._document_lock:
+                if self._document is None:
+                    self._document = self._load_document()
+        return self._document
+
+    def _load_document(self) -> Mapping[str, Any]:
+        path = (
+            f"{DISCOVERY_CACHE_PATH}/{API_SERVICE_NAME}.{API_VERSION}.json")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                content = file.read()
+        else:
+            content = get_static_doc(API_SERVICE_NAME, API_VERSION)
+            if content is None:
+                content = self._fetch_document()
+            os.makedirs(DISCOVERY_CACHE_PATH, exist_ok=True)
+            # A file of its own, as other processes may be writing too.
+            fd, tmp_path = tempfile.mkstemp(
+                dir=DISCOVERY_CACHE_PATH, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as file:
+                    file.write(content)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            logger.info(f"Cached discovery document at {path}")
+        return json.loads(content)
+
+    def _fetch_document(self) -> str:
+        url = DISCOVERY_URL.format(
+            api=API_SERVICE_NAME, version=API_VERSION)
+        rsp, content = httplib2.Http(timeout=HTTP_TIMEOUT_S).request(url)
+        if rsp.status != 200:
+            raise DependencyException(
+                f"Failed to fetch discovery document {url}: {rsp.status}")
+        return content.decode("utf-8")
+
+    def api_key_client(self) -> Resource:
+        """
+        Client with the API key only, for public data. Its GET requests go
+        through `etag_cache`.
+        """
+        if self._api_key_client is None:
+            self.etag_cache = ETagCache(httplib2.Http(timeout=HTTP_TIMEOUT_S))
+            self._api_key_client = build_from_document(
+                self.document(),
+                http=self.etag_cache,
+                developerKey=YOUTUBE_API_KEY,
+            )
+        return self._api_key_client
+
+    def user_client(self, user_id: int, credentials: Credentials) -> Resource:
+        """
+        Client authorized as the user. It is rebuilt when given credentials
+        other than the ones it was built with, e.g after re-authorization.
+        """
+        entry = self._user_clients.get(user_id)
+        if entry is not None and entry[0] is credentials:
+            return entry[1]
+        client = build_from_document(
+            self.document(),
+            http=AuthorizedHttp(
+                credentials,
+                http=httplib2.Http(timeout=HTTP_TIMEOUT_S),
+            ),
+            developerKey=YOUTUBE_API_KEY,
+        )
+        self._user_clients[user_id] = (credentials, client)
+        return client
+
+    def thread_http(self, credentials: Credentials) -> AuthorizedHttp:
+        """
+        HTTP authorized as `credentials` on connections kept by the calling
+        thread. httplib2 isn't thread safe, so clients used off the event
+        loop thread pass this to execute() or next_chunk().
+        """
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = httplib2.Http(timeout=HTTP_TIMEOUT_S)
+            self._local.http = http
+        return AuthorizedHttp(credentials, http=http)
+
+    def invalidate(self, user_id: int) -> None:
+        self._user_clients.pop(user_id, None)
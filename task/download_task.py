@@ -1,8 +1,15 @@
 import asyncio
+import os
+import re
+import threading
 import time
 import json
 
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Mapping, Optional
 from task.task import Task, Request, Response
+from lib import process
 from lib.exception import (
     TimeoutException,
     UnknownException,
@@ -14,6 +21,33 @@ from lib.log import get_logger
 
 logger = get_logger(__file__)
 
+# youtube-dl errors for videos which can't be downloaded by anyone but the
+# owner, so there is no point in retrying.
+UNAVAILABLE_ERRORS = [
+    "Private video",
+    "Video unavailable",
+    "This video is not available",
+    "members-only",
+    "Sign in to confirm your age",
+]
+
+# Max number of youtube-dl runs at once in this process, either subprocesses
+# or LibraryBackend threads.
+MAX_PROCESSES = 4
+# yt-dlp, as youtube-dl prints no progress along with its json output.
+YOUTUBE_DL = "yt-dlp"
+# One of BACKENDS.
+DOWNLOAD_BACKEND = "subprocess"
+# for lowest cost, download audio only
+# see also: https://github.com/ytdl-org/youtube-dl#format-selection
+FORMAT = "worstaudio/worst/bestaudio"
+# Log download progress every this many percent.
+PROGRESS_LOG_STEP = 25
+
+_processes = asyncio.Semaphore(MAX_PROCESSES)
+# e.g "[download]  42.5% of 3.21MiB at  1.02MiB/s ETA 00:01"
+_PROGRESS = re.compile(r"^\[download\]\s+([\d.]+)%")
+
 # https://developers.google.com/youtube/v3/docs/search/list
 # https://github.com/ytdl-org/youtube-dl
 
@@ -22,115 +56,348 @@ class DownloadRequest(Request):
     # Youtube video uuid, e.g '5FpCdgZ-Jtk&t=20s'
     uuid: str
     # path to download audio/video, e.g /tmp/yt_download
-    path: str
+    path: str = ""
     timeout: int
+    # Only fetch the video info, which is a lot faster than downloading.
+    skip_download: bool = False
 
 
 class DownloadResponse(Response):
-    title: str
-    description: str
-    duration_s: int
+    title: Optional[str] = None
+    description: Optional[str] = None
+    # None for live streams and premieres which haven't started.
+    duration_s: Optional[int] = None
     # audio file extenstion. E.g webm for '5FpCdgZ-Jtk&t=20s.webm'
-    ext: str
+    ext: Optional[str] = None
+    is_live: bool = False
 
 
-class DownloadTask(Task):
+class Progress:
+    """
+    Logs youtube-dl's progress every PROGRESS_LOG_STEP percent.
+    """
 
-    async def start(self, req: DownloadRequest) -> DownloadResponse:
-        _start_time = time.time()
-        """
-        Example:
-        $youtube-dl -f 'worstaudio/worst/bestaudio' -o '%(id)s.%(ext)s'  --print-json JUVlHzfncjw
-        {"uuid"" "JUVlHzfncjw","title": "【恋爱记】创始人 付小龙，5000万用户app的9年坎坷发展史",..."description":"...","duration": 663,"ext": "webm",...}
-        """
-        if len(req.path) == 0:
-            raise BadRequestException("path can't be none or empty string")
-
-        path = req.path
-        if path[-1] == "/":
-            path = path[:-1]
-
-        output = f"{path}/%(id)s.%(ext)s"
+    def __init__(self, uuid: str):
+        self.uuid = uuid
+        self.logged = -PROGRESS_LOG_STEP
+
+    def update(self, line: str) -> None:
+        match = _PROGRESS.match(line)
+        if match is not None:
+            self.report(float(match.group(1)), line[10:].strip())
+
+    def report(self, percent: float, detail: str) -> None:
+        if percent - self.logged < PROGRESS_LOG_STEP and percent < 100:
+            return
+        if self.logged >= 100:
+            return
+        self.logged = percent
+        logger.info(f"Downloading {self.uuid}: {detail}")
+
+
+def raise_for_error(error: str) -> None:
+    if any(e in error for e in UNAVAILABLE_ERRORS):
+        raise BadRequestException(
+            "Please publish your video first. "
+            "Failed to download video with error: \n"
+            f"   '{error}' \n"
+        )
+    logger.error(error)
+    raise DependencyException(error)
+
+
+class DownloadBackend(ABC):
+    """
+    Runs youtube-dl for one video and returns its video info.
+    """
+
+    @abstractmethod
+    async def run(
+        self,
+        uuid: str,
+        # output template, or None to skip the download.
+        output: Optional[str],
+        timeout: float,
+        progress: Progress,
+    ) -> Mapping[str, Any]:
+        ...
+
+
+class SubprocessBackend(DownloadBackend):
+    """
+    Runs the youtube-dl command, which costs a python interpreter start per
+    run but can be killed on timeout.
+
+    Example:
+    $youtube-dl -f 'worstaudio/worst/bestaudio' -o '%(id)s.%(ext)s'  --print-json JUVlHzfncjw
+    {"uuid"" "JUVlHzfncjw","title": "【恋爱记】创始人 付小龙，5000万用户app的9年坎坷发展史",..."description":"...","duration": 663,"ext": "webm",...}
+
+    With skip_download:
+    $youtube-dl -f 'worstaudio/worst/bestaudio' --skip-download --dump-json JUVlHzfncjw
+    """
+
+    def __init__(self, cmd: str = YOUTUBE_DL):
+        self.cmd = cmd
+        # --print-json implies --quiet, which only yt-dlp can override to
+        # keep the progress lines.
+        self.progress_flags = (
+            ["--progress"] if "yt-dlp" in os.path.basename(cmd) else [])
+
+    async def run(
+        self,
+        uuid: str,
+        output: Optional[str],
+        timeout: float,
+        progress: Progress,
+    ) -> Mapping[str, Any]:
         cmd = [
-            "youtube-dl",
-            # for lowest cost, download audio only
-            # see also: https://github.com/ytdl-org/youtube-dl#format-selection
-            "--format worstaudio/worst/bestaudio",
-            # E.g '5FpCdgZ-Jtk&t=20s.webm'
-            f"--output '{output}'",
-            "--print-json",
-            req.uuid,
+            self.cmd,
+            "--format", FORMAT,
+            # one progress line per update instead of rewriting it with \r
+            "--newline",
         ]
+        if output is None:
+            cmd += [
+                "--skip-download",
+                "--dump-json",
+            ]
+        else:
+            cmd += [
+                # E.g '5FpCdgZ-Jtk&t=20s.webm'
+                "--output", output,
+                "--print-json",
+            ] + self.progress_flags
+        # uuids may start with '-', e.g '-5FpCdgZ-Jt'
+        cmd += ["--", uuid]
+
+        info_lines = []
+
+        def on_stdout(line: str) -> None:
+            if line.startswith("{"):
+                info_lines.append(line)
+            else:
+                progress.update(line)
 
         logger.info(f"Going to run command:\n {' '.join(cmd)}")
-        subprocess = await asyncio.create_subprocess_shell(
-            " ".join(cmd),
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+        result = await process.supervise(
+            cmd, timeout=timeout, on_stdout=on_stdout)
+
+        stderr = result.stderr
+        if result.returncode != 0 or not info_lines:
+            raise_for_error(
+                f"subprocess:\n ${' '.join(cmd)}\n"
+                f"Failed with return code: {result.returncode}\n"
+                f"stderror: {stderr}\n"
+            )
+        if stderr:
+            logger.warning(f"youtube-dl {uuid} stderr: {stderr}")
         try:
-            stdout, stderr = await asyncio.wait_for(
-                subprocess.communicate(),
-                timeout=req.timeout,
+            return json.loads(info_lines[-1])
+        except Exception as e:
+            msg = (
+                f"Parse video info from json:\nstdout\n"
+                f"failed with error: {e}"
             )
-        except TimeoutError as e:
+            logger.error(msg)
+            raise DependencyException(msg) from e
+
+
+class _YoutubeDLLogger:
+
+    def debug(self, msg: str) -> None:
+        logger.debug(msg)
+
+    def info(self, msg: str) -> None:
+        logger.debug(msg)
+
+    def warning(self, msg: str) -> None:
+        logger.warning(msg)
+
+    def error(self, msg: str) -> None:
+        logger.error(msg)
+
+
+class LibraryBackend(DownloadBackend):
+    """
+    Runs yt-dlp, or youtube-dl if it isn't installed, as a library on a
+    thread pool. Each thread keeps one YoutubeDL, and with it the HTTP
+    connections, across runs.
+
+    A thread can't be killed, so on timeout the run is abandoned and its
+    thread is busy until youtube-dl's socket timeout.
+    """
+
+    def __init__(self, workers: int = MAX_PROCESSES):
+        try:
+            import yt_dlp as youtube_dl
+        except ImportError:
+            try:
+                import youtube_dl
+            except ImportError as e:
+                raise DependencyException(
+                    "LibraryBackend needs yt-dlp or youtube-dl installed"
+                ) from e
+        self._youtube_dl = youtube_dl
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="youtube-dl",
+        )
+        self._local = threading.local()
+
+    def _ydl(self) -> Any:
+        ydl = getattr(self._local, "ydl", None)
+        if ydl is None:
+            ydl = self._youtube_dl.YoutubeDL({
+                "format": FORMAT,
+                "quiet": True,
+                "noprogress": True,
+                "logger": _YoutubeDLLogger(),
+                "progress_hooks": [self._on_progress],
+            })
+            self._local.ydl = ydl
+        return ydl
+
+    def _on_progress(self, status: Mapping[str, Any]) -> None:
+        progress = getattr(self._local, "progress", None)
+        total = status.get("total_bytes") or status.get("total_bytes_estimate")
+        if progress is None or not total:
+            return
+        downloaded = status.get("downloaded_bytes") or 0
+        progress.report(
+            100 * downloaded / total,
+            f"{downloaded} of {total} bytes",
+        )
+
+    def _run(
+        self,
+        uuid: str,
+        output: Optional[str],
+        timeout: float,
+        progress: Progress,
+    ) -> Mapping[str, Any]:
+        ydl = self._ydl()
+        ydl.params["socket_timeout"] = timeout
+        if output is not None:
+            outtmpl = ydl.params.get("outtmpl")
+            if isinstance(outtmpl, dict):
+                # yt-dlp
+                outtmpl["default"] = output
+            else:
+                ydl.params["outtmpl"] = output
+        self._local.progress = progress
+        try:
+            info = ydl.extract_info(uuid, download=output is not None)
+        except self._youtube_dl.utils.DownloadError as e:
+            raise_for_error(str(e))
+        finally:
+            self._local.progress = None
+        if hasattr(ydl, "sanitize_info"):
+            info = ydl.sanitize_info(info)
+        return info
+
+    async def run(
+        self,
+        uuid: str,
+        output: Optional[str],
+        timeout: float,
+        progress: Progress,
+    ) -> Mapping[str, Any]:
+        logger.info(f"Going to run youtube-dl library for: {uuid}")
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._run, uuid, output, timeout, progress)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError as e:
+            raise TimeoutException(
+                f"Abandoned youtube-dl run for {uuid} after timeout of "
+                f"{timeout}s"
+            ) from e
+
+
+BACKENDS = {
+    "subprocess": SubprocessBackend,
+    "library": LibraryBackend,
+}
+
+_backends: Dict[str, DownloadBackend] = {}
+
+
+def get_backend(name: str) -> DownloadBackend:
+    """
+    Shared instance of the backend, so LibraryBackend threads are reused.
+    """
+    if name not in BACKENDS:
+        raise BadRequestException(
+            f"Unsupported download backend: {name}, expect one of "
+            f"{list(BACKENDS)}"
+        )
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+
+class DownloadTask(Task):
+
+    def __init__(self, backend: str = DOWNLOAD_BACKEND):
+        self.backend = backend
+
+    async def start(self, req: DownloadRequest) -> DownloadResponse:
+        _start_time = time.time()
+        output = None
+        if not req.skip_download:
+            if len(req.path) == 0:
+                raise BadRequestException(
+                    "path can't be none or empty string")
+
+            path = req.path
+            if path[-1] == "/":
+                path = path[:-1]
+            output = f"{path}/%(id)s.%(ext)s"
+
+        backend = get_backend(self.backend)
+        try:
+            async with _processes:
+                video_info = await backend.run(
+                    req.uuid,
+                    output,
+                    req.timeout,
+                    Progress(req.uuid),
+                )
+        except TimeoutException as e:
             msg = (
                 f"Download timeout-ed after: {time.time() - _start_time}s"
                 f" while timeout is: {req.timeout}. Error detail: {e}"
             )
             logger.error(msg)
             raise TimeoutException(msg) from e
+        except (BadRequestException, DependencyException):
+            raise
         except Exception as e:
             raise UnknownException(str(e)) from e
 
-        if subprocess.returncode == 0 and (stderr is None or len(stderr) == 0):
-            try:
-                video_info = json.loads(stdout)
-            except Exception as e:
-                msg = (
-                    f"Parse video info from json:\nstdout\n"
-                    f"failed with error: {e}"
-                )
-                logger.error(msg)
-                raise DependencyException(msg) from e
-
-            title = video_info.get("title", None)
-            duration_s = video_info.get("duration", None)
-            ext = video_info.get("ext", None)
-            description = video_info.get("description", None)
-
-            if any(v is None for v in [
-                    title,
-                    duration_s,
-                    ext,
-                    description,
-            ]):
-                logger.warning(
-                    "None of following video info expect to be empty but got: "
-                    f"title: {title}, duration: {duration_s}, ext: {ext}, "
-                    f"description: {description}"
-                )
-            return DownloadResponse(
-                title=title,
-                duration_s=duration_s,
-                ext=ext,
-                description=description,
-            )
-        elif "Private video" in str(stderr):
-            raise BadRequestException(
-                "Please publish your video first. "
-                "Failed to download video with error: \n"
-                f"   '{str(stderr)}' \n"
-            )
-        else:
-            msg = (
-                f"subprocess:\n ${' '.join(cmd)}\n"
-                f"Failed with return code: {subprocess.returncode}\n"
-                f"stdout: {stdout}\n"
-                f"stderror: {stderr}\n"
+        title = video_info.get("title", None)
+        duration_s = video_info.get("duration", None)
+        ext = video_info.get("ext", None)
+        description = video_info.get("description", None)
+
+        if any(v is None for v in [
+                title,
+                duration_s,
+                ext,
+                description,
+        ]):
+            logger.warning(
+                "None of following video info expect to be empty but got: "
+                f"title: {title}, duration: {duration_s}, ext: {ext}, "
+                f"description: {description}"
             )
-            logger.error(msg)
-            raise DependencyException(msg)
+        return DownloadResponse(
+            title=title,
+            duration_s=duration_s,
+            ext=ext,
+            description=description,
+            is_live=bool(video_info.get("is_live", False)),
+        )
 
 
 # ------------- TEST -------------
@@ -1,8 +1,10 @@
 import asyncio
+import re
 
-from googleapiclient.discovery import build
-from lib.config import YOUTUBE_API_KEY, API_VERSION
+from lib.channel import Channel, ChannelSync
+from lib.quota import QuotaBudget
 from lib.video import Video
+from lib.youtube import YouTubeClients
 from task.task import Task, Request, Response
 from typing import List, Optional
 from lib.log import get_logger
@@ -10,8 +12,10 @@ from lib.log import get_logger
 
 logger = get_logger(__file__)
 
-
-API_SERVICE_NAME = "youtube"
+# e.g UCR2LHLiQmL_zEJnlCiyyxAA
+_CHANNEL_ID = re.compile(r"UC[\w-]{22}")
+# Most items playlistItems().list returns per page.
+MAX_PAGE_SIZE = 50
 
 
 class GetVideoRequest(Request):
@@ -23,6 +27,12 @@ class GetVideoRequest(Request):
     channel_title: str
     # Max number of video returns in each response
     max_video: int
+    # Workflow and user the videos are found for.
+    workflow_id: int = 0
+    user_id: int = 0
+    # Read the uploads playlist back to the user's watermark of the channel,
+    # instead of searching its latest videos.
+    sync: bool = False
     # "none" video without captions only
     # "closedCaption" Only include videos that have captions.
     # "any"  Do not filter results based on caption availability.
@@ -32,27 +42,74 @@ class GetVideoRequest(Request):
 # videoCaption
 class GetVideoResponse(Response):
     videos: List[Video]
+    # With sync, the watermark moved to the newest video found. Save it once
+    # the videos are handled.
+    channel_sync: Optional[ChannelSync] = None
 
 
 # TODO install youtube client
 class GetVideoTask(Task):
     def init(self) -> "GetVideoTask":
-        self.youtube = build(
-            API_SERVICE_NAME,
-            API_VERSION,
-            developerKey=YOUTUBE_API_KEY,
-        )
+        self.youtube = YouTubeClients().api_key_client()
         return self
 
-    # TODO cache it.
-    def get_channel_id(self, channel_title: str) -> Optional[str]:
+    async def get_channel_id(self, channel_title: str) -> Optional[str]:
+        """
+        Resolve the channel title, handle or id from the channel cache, or
+        else with the cheapest lookup that works:
+        channels().list by id or handle costs 1 quota unit,
+        search().list costs 100. Queries no channel is found for are cached
+        too, for a shorter time.
+        """
+        query = channel_title.strip()
+        channel = await Channel.find(query)
+        if channel is not None:
+            if channel.channel_id is None:
+                logger.error(
+                    f"No channel found for channel title: {channel_title}")
+            return channel.channel_id
+
+        channel_id = None
+        if _CHANNEL_ID.fullmatch(query):
+            channel_id = await self.list_channel_id(id=query)
+        elif not any(c.isspace() for c in query):
+            channel_id = await self.list_channel_id(
+                forHandle=query if query.startswith("@") else f"@{query}")
+        if channel_id is None:
+            channel_id = await self.search_channel_id(query)
+        if channel_id is None:
+            logger.error(
+                f"Failed to get channel id for channel title: {channel_title}")
+            await Channel(query=query, channel_id=None).save()
+            return None
+
+        logger.info(
+            f"Got Channal id: {channel_id} for"
+            f" channel title: {channel_title}"
+        )
+        await Channel(query=query, channel_id=channel_id).save()
+        return channel_id
+
+    async def list_channel_id(self, **kwargs: str) -> Optional[str]:
+        await QuotaBudget().acquire("channels.list")
+        list_rst = (
+            self.youtube.channels()
+            .list(part="id", **kwargs)
+            .execute()
+        )
+        for item in list_rst.get("items", []):
+            return item["id"]
+        return None
+
+    async def search_channel_id(self, channel_title: str) -> Optional[str]:
+        await QuotaBudget().acquire("search.list")
         search_rst = (
             self.youtube.search()
             .list(
                 part="id,snippet",
                 q=channel_title,
                 maxResults=1,
-                type="video",
+                type="channel",
                 order="relevance",
             )
             .execute()
@@ -60,22 +117,25 @@ class GetVideoTask(Task):
 
         for item in search_rst.get("items", []):
             if "snippet" in item.keys() and "channelId" in item["snippet"]:
-                channel_id = item["snippet"]["channelId"]
-                logger.info(
-                    f"Got Channal id: {channel_id} for"
-                    f" channel title: {channel_title}"
-                )
-                return channel_id
-        logger.error(
-            f"Failed to get channel id for channel title: {channel_title}")
+                return item["snippet"]["channelId"]
         return None
 
+    def new_video(self, req: GetVideoRequest, uuid: str) -> Video:
+        return Video(
+            workflow_id=req.workflow_id,
+            user_id=req.user_id,
+            uuid=uuid,
+        )
+
     async def start(self, req: GetVideoRequest) -> GetVideoResponse:
         videos = []
-        channel_id = self.get_channel_id(req.channel_title)
+        channel_id = await self.get_channel_id(req.channel_title)
         if not channel_id:
-            return GetVideoResponse(videos)
+            return GetVideoResponse(videos=videos)
+        if req.sync:
+            return await self.sync(req, channel_id)
 
+        await QuotaBudget().acquire("search.list")
         search_rst = (
             self.youtube.search()
             .list(
@@ -89,19 +149,84 @@ class GetVideoTask(Task):
 
         for item in search_rst.get("items", []):
             if "id" in item.keys() and "videoId" in item["id"]:
-                video = Video(
-                    uuid=item["id"]["videoId"],
-                )
+                video = self.new_video(req, item["id"]["videoId"])
                 if "snippet" in item.keys():
                     video.set_snippet(item["snippet"])
                 videos.append(video)
 
         logger.info(
-            f"Found following videos: {[v.id for v in videos]} "
+            f"Found following videos: {[v.uuid for v in videos]} "
             f"for channel: {req.channel_title}"
         )
         return GetVideoResponse(videos=videos)
 
+    async def sync(
+        self,
+        req: GetVideoRequest,
+        channel_id: str,
+    ) -> GetVideoResponse:
+        """
+        Page through the channel's uploads playlist, newest first, at 1
+        quota unit per page, back to the user's watermark, and return the
+        oldest max_video new videos. The watermark moves to the newest of
+        those, so the rest are returned by the next syncs. Without a
+        watermark, only the newest max_video videos are returned.
+        """
+        channel_sync = await ChannelSync.find(channel_id, req.user_id)
+        watermark = channel_sync.published_at
+        # The uploads playlist of channel UCxxx is UUxxx.
+        playlist_id = f"UU{channel_id[2:]}"
+        # (publishedAt, video), newest first.
+        found = []
+        page_token = None
+        done = False
+        while not done:
+            await QuotaBudget().acquire("playlistItems.list")
+            list_rst = (
+                self.youtube.playlistItems()
+                .list(
+                    part="snippet,contentDetails",
+                    playlistId=playlist_id,
+                    maxResults=(
+                        MAX_PAGE_SIZE if watermark
+                        else min(MAX_PAGE_SIZE, req.max_video)
+                    ),
+                    pageToken=page_token,
+                )
+                .execute()
+            )
+            for item in list_rst.get("items", []):
+                snippet = item.get("snippet", {})
+                details = item.get("contentDetails", {})
+                published_at = details.get(
+                    "videoPublishedAt", snippet.get("publishedAt"))
+                if watermark and published_at and published_at <= watermark:
+                    done = True
+                    break
+                video = self.new_video(req, details["videoId"])
+                video.set_snippet(snippet)
+                found.append((published_at, video))
+                if not watermark and len(found) >= req.max_video:
+                    done = True
+                    break
+            page_token = list_rst.get("nextPageToken")
+            if page_token is None:
+                done = True
+
+        if watermark:
+            # Oldest first, so videos past max_video aren't skipped.
+            found = found[::-1][:req.max_video]
+        videos = [video for _, video in found]
+        published = [
+            published_at for published_at, _ in found if published_at]
+        newest = max(published) if published else watermark
+        logger.info(
+            f"Synced {len(videos)} new videos {[v.uuid for v in videos]} "
+            f"for channel: {req.channel_title} after {watermark}"
+        )
+        channel_sync.published_at = newest
+        return GetVideoResponse(videos=videos, channel_sync=channel_sync)
+
 
 # ------------- TEST -------------
 # $cd ~/Documents/github/cap/worker
@@ -170,7 +295,7 @@ async def test_get_sophia1_549_video():
     )
     print(
         "Got follow top 10 video for channel "
-        f"'{channel_title}':\n {','.join([v.id for v in rsp.videos])}"
+        f"'{channel_title}':\n {','.join([v.uuid for v in rsp.videos])}"
     )
 
 
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import time
+
+from typing import Optional
+
+from task.task import Task, Request, Response
+from lib import audio
+from lib.exception import BadRequestException
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+# Max number of ffmpeg processes transcoding at once in this process.
+MAX_PROCESSES = 2
+# Output format -> (extension, ffmpeg encoder, bitrate).
+FORMATS = {
+    "opus": ("webm", "libopus", "24k"),
+    "mp3": ("mp3", "libmp3lame", "32k"),
+}
+
+_processes = asyncio.Semaphore(MAX_PROCESSES)
+
+
+class TranscodeRequest(Request):
+    # path to the downloaded audio/video, e.g /tmp/yt_download/JUVlHzfncjw.webm
+    path: str
+    # one of FORMATS
+    fmt: str = "opus"
+    # directory of the transcoded file, by default the one of `path`.
+    dir: Optional[str] = None
+
+
+class TranscodeResponse(Response):
+    # path to the smaller of the original and the transcoded file.
+    path: str
+    src_bytes: int
+    dst_bytes: int
+
+
+class TranscodeTask(Task):
+
+    async def start(self, req: TranscodeRequest) -> TranscodeResponse:
+        """
+        Example:
+        $ffmpeg -i JUVlHzfncjw.webm -vn -ac 1 -ar 16000 -c:a libopus -b:a 24k JUVlHzfncjw.mono.webm
+        """
+        if req.fmt not in FORMATS:
+            raise BadRequestException(
+                f"Unsupported format: {req.fmt}, expect one of {FORMATS}")
+
+        _start_time = time.time()
+        ext, codec, bitrate = FORMATS[req.fmt]
+        dst = f"{os.path.splitext(req.path)[0]}.mono.{ext}"
+        if req.dir is not None:
+            os.makedirs(req.dir, exist_ok=True)
+            dst = f"{req.dir}/{os.path.basename(dst)}"
+        async with _processes:
+            await audio.transcode(req.path, dst, codec, bitrate)
+
+        src_bytes = os.path.getsize(req.path)
+        dst_bytes = os.path.getsize(dst)
+        logger.info(
+            f"Transcoded {req.path} from {src_bytes} to {dst_bytes} bytes "
+            f"in {time.time() - _start_time:.1f}s"
+        )
+        if dst_bytes >= src_bytes:
+            os.remove(dst)
+            dst = req.path
+        return TranscodeResponse(
+            path=dst,
+            src_bytes=src_bytes,
+            dst_bytes=dst_bytes,
+        )
+
+
+# ------------- TEST -------------
+# $cd ~/Documents/github/cap/worker
+# $python3 -m task.transcode_task task/transcode_task.py
+async def test_transcode_success() -> None:
+    req = TranscodeRequest(
+        path="/tmp/yt_download/JUVlHzfncjw.webm",
+    )
+    rsp = await TranscodeTask().start(req)
+    print(f"success and got response: {rsp}")
+
+
+def main() -> None:
+    asyncio.run(test_transcode_success())
+
+
+if __name__ == "__main__":
+    print("running main.......")
+    main()
@@ -1,40 +1,245 @@
 import asyncio
-import openai
+import json
+import os
+import shutil
+import tempfile
 
+from abc import ABC, abstractmethod
 
 from task.task import Task, Request, Response
+from lib import audio, subtitle
 from lib.video import Video
-from lib.config import OPENAI_API_KEY
-from typing import List, Optional
+from lib.exception import BadRequestException
+from lib.local_whisper import LocalWhisper
+from lib.whisper import WhisperClient
+from typing import Dict, List, Optional, Sequence, Tuple
 from lib.log import get_logger
 
 
 logger = get_logger(__file__)
 
 OPENAI_DOMAIN = "https://api.openai.com/v1/"
+# Whisper API rejects larger uploads.
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+# Media longer or larger than one chunk is cut at silences into chunks, which
+# are transcribed concurrently.
+CHUNK_MAX_S = 10 * 60
+CHUNK_MAX_BYTES = 20 * 1024 * 1024
+CHUNK_CONCURRENCY = 4
+# trunk-ignore(bandit/B108)
+CHUNK_PATH = "/tmp/workflow/chunk"
+# One of ENGINES.
+TRANSCRIPT_ENGINE = "openai"
+# route_engine() sends videos up to this long to the local engine, 0 for
+# none of them.
+LOCAL_MAX_DURATION_S = 0
 
 
 class TranscriptRequest(Request):
     video: Video
     language: Optional[str]
-    transcript_fmt: str
+    # any of subtitle.FORMATS, all rendered from one transcription.
+    transcript_fmts: List[str]
     promot: Optional[str]
+    # One of ENGINES, see also route_engine().
+    engine: str = TRANSCRIPT_ENGINE
 
 
 class TranscriptResponse(Response):
     video: Video
 
 
-class TranscriptTask(Task):
+class TranscriptionEngine(ABC):
+    """
+    Transcribes the media of one video as verbose_json, whose timestamped
+    segments every other format is rendered from.
+    """
+
+    @abstractmethod
+    async def transcribe(
+        self,
+        video: Video,
+        language: Optional[str],
+        prompt: str,
+    ) -> str:
+        ...
+
+
+class OpenAIEngine(TranscriptionEngine):
+    """
+    Whisper API, billed per minute. Media larger or longer than the API
+    takes is cut into chunks which are transcribed concurrently.
+    """
 
     async def transcribe(
+        self,
+        video: Video,
+        language: Optional[str],
+        prompt: str,
+    ) -> str:
+        if self.should_chunk(video):
+            return await self.transcribe_chunks(
+                video, subtitle.VERBOSE_JSON, language, prompt)
+        return await self.transcribe_file(
+            video.path, subtitle.VERBOSE_JSON, language, prompt)
+
+    async def transcribe_file(
+            self,
+            path: str,
+            transcript_fmt: str,
+            language: Optional[str],
+            prompt: str,
+    ) -> str:
+        transcript = await WhisperClient().transcribe(
+            path,
+            prompt=prompt,
+            response_format=transcript_fmt,
+            language=language,
+        )
+        if not isinstance(transcript, str):
+            # json and verbose_json come back parsed.
+            return json.dumps(transcript, ensure_ascii=False)
+        transcript_bytes = bytes(transcript, "utf-8")
+        return transcript_bytes.decode()
+
+    def should_chunk(self, video: Video) -> bool:
+        size = os.path.getsize(video.path)
+        duration_s = video.snippet.get("duration", None)
+        if size <= CHUNK_MAX_BYTES and (
+            duration_s is not None and duration_s <= CHUNK_MAX_S
+        ):
+            return False
+        if not audio.has_ffmpeg():
+            if size > MAX_UPLOAD_BYTES:
+                logger.warning(
+                    f"{video.path} is {size} bytes, larger than Whisper "
+                    f"accepts, but ffmpeg isn't installed to chunk it."
+                )
+            return False
+        return True
+
+    async def transcribe_chunks(
             self,
             video: Video,
             transcript_fmt: str,
             language: Optional[str],
+            prompt: str,
+    ) -> str:
+        path = video.path
+        duration_s = await audio.probe_duration(path)
+        bytes_per_s = os.path.getsize(path) / max(duration_s, 1)
+        max_chunk_s = min(CHUNK_MAX_S, CHUNK_MAX_BYTES / bytes_per_s)
+        silences = await audio.detect_silences(path, duration_s)
+        chunks = audio.plan_chunks(duration_s, silences, max_chunk_s)
+        logger.info(
+            f"Transcribing {path} of {duration_s}s in {len(chunks)} chunks")
+
+        os.makedirs(CHUNK_PATH, exist_ok=True)
+        chunk_dir = tempfile.mkdtemp(prefix=f"{video.uuid}-", dir=CHUNK_PATH)
+        ext = os.path.splitext(path)[1]
+        semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+
+        async def transcribe_chunk(
+                i: int, start: float, end: float) -> Tuple[float, str]:
+            async with semaphore:
+                chunk_path = await audio.cut(
+                    path, start, end, f"{chunk_dir}/{i}{ext}")
+                transcript = await self.transcribe_file(
+                    chunk_path, transcript_fmt, language, prompt)
+                return start, transcript
+
+        tasks = [
+            asyncio.create_task(transcribe_chunk(i, start, end))
+            for i, (start, end) in enumerate(chunks)
+        ]
+        try:
+            parts = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+        return subtitle.stitch(transcript_fmt, parts)
+
+
+class LocalEngine(TranscriptionEngine):
+    """
+    Whisper on this machine's CPU, see LocalWhisper. Jobs are batched
+    together, so the prompt, which would have to be shared by the batch,
+    isn't used.
+    """
+
+    def __init__(self):
+        self._whisper = LocalWhisper()
+
+    async def transcribe(
+        self,
+        video: Video,
+        language: Optional[str],
+        prompt: str,
+    ) -> str:
+        return await self._whisper.transcribe(video.path, language)
+
+
+ENGINES = {
+    "openai": OpenAIEngine,
+    "local": LocalEngine,
+}
+
+_engines: Dict[str, TranscriptionEngine] = {}
+
+
+def get_engine(name: str) -> TranscriptionEngine:
+    if name not in ENGINES:
+        raise BadRequestException(
+            f"Unsupported transcription engine: {name}, expect one of "
+            f"{list(ENGINES)}"
+        )
+    if name not in _engines:
+        _engines[name] = ENGINES[name]()
+    return _engines[name]
+
+
+def route_engine(
+    duration_s: Optional[float],
+    local_max_duration_s: float = LOCAL_MAX_DURATION_S,
+) -> str:
+    """
+    The local engine for videos up to `local_max_duration_s`, which batch
+    well and cost nothing per minute. The OpenAI engine for longer ones,
+    whose chunks it transcribes concurrently, and for unknown durations.
+    """
+    if (
+        local_max_duration_s > 0
+        and duration_s is not None
+        and duration_s <= local_max_duration_s
+    ):
+        return "local"
+    return TRANSCRIPT_ENGINE
+
+
+class TranscriptTask(Task):
+
+    async def transcribe(
+            self,
+            video: Video,
+            transcript_fmts: Sequence[str],
+            language: Optional[str],
             promot: Optional[str],
+            engine: str = TRANSCRIPT_ENGINE,
     ) -> Video:
-        openai.api_key = OPENAI_API_KEY
+        """
+        Transcribe once as verbose_json, whose timestamped segments every
+        other format is rendered from.
+        """
+        unsupported = set(transcript_fmts) - set(subtitle.FORMATS)
+        if unsupported:
+            raise BadRequestException(
+                f"Unsupported transcript formats: {unsupported}, "
+                f"expect any of {subtitle.FORMATS}"
+            )
 
         prompts = []
         if promot:
@@ -48,25 +253,20 @@ class TranscriptTask(Task):
         if "description" in snippet.keys():
             prompts.append(snippet["description"])
 
-        with open(video.path, "rb") as file:
-            transcript = await openai.Audio.atranscribe(
-                model="whisper-1",
-                file=file,
-                prompt=";".join(prompts),
-                response_format=transcript_fmt,
-                language=language,
-            )
-            transcript_bytes = bytes(transcript, "utf-8")
-            transcript_decode = transcript_bytes.decode()
-            video.set_srt(transcript_decode)
+        prompt = ";".join(prompts)
+        verbose_json = await get_engine(engine).transcribe(
+            video, language, prompt)
+        for fmt in transcript_fmts:
+            video.set_transcript(fmt, subtitle.render(fmt, verbose_json))
         return video
 
     async def start(self, req: TranscriptRequest) -> TranscriptResponse:
         transcribe_video = await self.transcribe(
             video=req.video,
             language=req.language,
-            transcript_fmt=req.transcript_fmt,
+            transcript_fmts=req.transcript_fmts,
             promot=req.promot,
+            engine=req.engine,
         )
 
         return TranscriptResponse(video=transcribe_video)
@@ -87,7 +287,7 @@ async def test_transcript_a_video() -> None:
     rsp = await task.start(TranscriptRequest(
         video=video,
         language=None,  # "zh",
-        transcript_fmts="srt",
+        transcript_fmts=["srt", "vtt"],
         promot=None
     ))
     # trunk-ignore(bandit/B101)
@@ -0,0 +1,142 @@
+import asyncio
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from lib.log import get_logger
+
+
+logger = get_logger(__file__)
+
+
+Handler = Callable[[Any], Awaitable[Optional[Any]]]
+ErrorHandler = Callable[[Any, Exception], Awaitable[None]]
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        handler: Handler,
+        concurrency: int,
+        queue_size: Optional[int] = None,
+    ) -> None:
+        self.name = name
+        # Returns the job for the next stage, or None if the job ends here.
+        self.handler = handler
+        # Number of jobs this stage works on at once.
+        self.concurrency = concurrency
+        # Number of jobs waiting for this stage. One per worker by default.
+        self.queue_size = queue_size or concurrency
+
+
+class Pipeline:
+    """
+    Runs jobs through stages connected by bounded queues, each stage with its
+    own number of workers. A worker that finished a job waits until the next
+    stage has room for it, so a slow stage holds back the stages before it
+    instead of piling up jobs (and downloaded files) in between.
+
+    Example:
+    pipeline = Pipeline(
+        [Stage("download", download, 2), Stage("transcribe", transcribe, 4)],
+        on_error=on_error,
+    )
+    pipeline.start()
+    await pipeline.submit(job)
+    """
+
+    def __init__(self, stages: List[Stage], on_error: ErrorHandler) -> None:
+        self.stages = stages
+        self.on_error = on_error
+        # Upper bound of jobs inside the pipeline, waiting or in progress.
+        self.max_in_flight = sum(
+            stage.concurrency + stage.queue_size for stage in stages
+        )
+        self._queues = [
+            asyncio.Queue(maxsize=stage.queue_size) for stage in stages
+        ]
+        self._in_flight = 0
+        self._slot_freed = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        # worker -> job it is working on or handing to the next stage.
+        self._current: Dict[asyncio.Task, Any] = {}
+
+    def start(self) -> None:
+        for i, stage in enumerate(self.stages):
+            for n in range(stage.concurrency):
+                self._workers.append(
+                    asyncio.create_task(
+                        self._work(i),
+                        name=f"{stage.name}-{n}",
+                    )
+                )
+
+    def free_slots(self) -> int:
+        """
+        Number of jobs that can be submitted without waiting.
+        """
+        first = self._queues[0]
+        return min(
+            self.max_in_flight - self._in_flight,
+            first.maxsize - first.qsize(),
+        )
+
+    async def wait_for_slot(self) -> None:
+        while self.free_slots() <= 0:
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+
+    async def submit(self, job: Any) -> None:
+        self._in_flight += 1
+        await self._queues[0].put(job)
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._slot_freed.set()
+
+    async def _work(self, i: int) -> None:
+        stage = self.stages[i]
+        queue = self._queues[i]
+        is_last = i == len(self.stages) - 1
+        worker = asyncio.current_task()
+        while True:
+            job = await queue.get()
+            self._current[worker] = job
+            if i == 0:
+                self._slot_freed.set()
+            try:
+                out = await stage.handler(job)
+            except Exception as e:
+                logger.exception(
+                    f"Stage {stage.name} failed with error: \n{e}")
+                try:
+                    await self.on_error(job, e)
+                except Exception as e:
+                    logger.exception(
+                        f"Failed to handle error of stage {stage.name} "
+                        f"due to error: \n{e}"
+                    )
+                out = None
+
+            if out is None or is_last:
+                self._release()
+            else:
+                self._current[worker] = out
+                await self._queues[i + 1].put(out)
+            del self._current[worker]
+
+    async def close(self) -> List[Any]:
+        """
+        Cancel the workers and return the jobs they didn't finish, waiting
+        in a queue or in progress.
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        unfinished = list(self._current.values())
+        self._current = {}
+        for queue in self._queues:
+            while not queue.empty():
+                unfinished.append(queue.get_nowait())
+        return unfinished
@@ -1,35 +1,82 @@
 #!/usr/bin/env python3 -m workflow.single_video
 
+import argparse
 import asyncio
 import math
+import os
+import shutil
 import time
 
-from typing import Optional, Set
+from pydantic import field_validator
+from typing import Any, List, Mapping, Optional, Sequence, Set, Tuple
 from google.oauth2.credentials import Credentials
 
+from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
+from lib import audio, subtitle
 from lib.exception import IOException, UnknownException, DependencyException
 from lib.log import get_logger
+from lib.media_cache import MediaCache, SOURCE
+from lib.migration import migrate
+from lib.notifier import WorkNotifier
+from lib.transcript import Transcript, prompt_hash
 from lib.user import User
 from lib.video import Video
 from task.transcript_task import (
+    LOCAL_MAX_DURATION_S,
     TranscriptTask,
     TranscriptRequest,
+    get_engine,
+    route_engine,
 )
 from task.download_task import (
+    BACKENDS,
+    DOWNLOAD_BACKEND,
     DownloadRequest,
-    DownloadTask
+    DownloadTask,
+    get_backend,
+)
+from task.transcode_task import (
+    TranscodeRequest,
+    TranscodeTask,
+)
+from workflow.pipeline import Stage
+from workflow.workflow import (
+    Workflow,
+    BaseArgs,
+    Job,
+    Status,
+    WorkflowType,
 )
-from workflow.workflow import Workflow, BaseArgs, WorkflowType
 
 
 logger = get_logger(__file__)
-SLEEP_SECONDS = 6
+# Longest wait between polls when no wakeup arrives.
+MAX_SLEEP_SECONDS = 60
+# Number of workflows each pipeline stage works on at once in one worker
+# process. Downloads and Whisper calls mostly wait on the network.
+STAGE_CONCURRENCY = {
+    "probe": 2,
+    "download": 2,
+    "prep": 2,
+    "transcribe": 4,
+    "persist": 1,
+    "upload": 2,
+}
 
 
 TIMEOUT_S = 10 * 60
+PROBE_TIMEOUT_S = 60
+# Longest video accepted for transcription.
+MAX_DURATION_M = 3 * 60
 # trunk-ignore(bandit/B108)
 VIDEO_DOWNLOAD_PATH = "/tmp/workflow/video"
+# trunk-ignore(bandit/B108)
+TRANSCODE_PATH = "/tmp/workflow/transcode"
 DEFAULT_TRANSCRIPT_EXT = "srt"
+# Transcode downloads to small mono audio before uploading them to Whisper.
+# Skipped when ffmpeg isn't installed.
+TRANSCODE_AUDIO = True
+TRANSCODE_FMT = "opus"
 
 
 class Args(BaseArgs):
@@ -45,114 +92,350 @@ class Args(BaseArgs):
     """
     video_uuid: str  # TODO validation for this to return invliad uuid fast.
     auto_upload: bool
-    # TODO validation for language and transcript formats
+    # TODO validation for language
     language: Optional[str] = None
+    # any of subtitle.FORMATS.
     transcript_fmts: Set[str] = {"srt"}
     # TODO validation on promotes size.
     # TODO should be "prompts". Typo, but this has been copy past everywhere.
     promotes: Optional[str] = None
+    # Reuse a transcript made for any user of the same video, language,
+    # format and promotes instead of transcribing again. By default only
+    # when no custom promotes are given.
+    reuse_transcript: Optional[bool] = None
+
+    @field_validator("transcript_fmts")
+    @classmethod
+    def check_transcript_fmts(cls, transcript_fmts: Set[str]) -> Set[str]:
+        # Rejected when claimed, before anything is downloaded.
+        unsupported = transcript_fmts - set(subtitle.FORMATS)
+        if unsupported:
+            raise ValueError(
+                f"Unsupported transcript formats: {sorted(unsupported)}, "
+                f"expect any of {subtitle.FORMATS}"
+            )
+        return transcript_fmts
 
     @property
-    def transcript_fmt(self) -> str:
-        transcript_fmt = "srt"
-        if len(self.transcript_fmts) > 0:
-            transcript_fmt = list(self.transcript_fmts)[0]
-        if len(self.transcript_fmts) > 1:
-            logger.warning(
-                "More than one transcript_fmts "
-                f"requests: {self.transcript_fmts} "
-                f"which is not supported now. "
-                f"Taking {transcript_fmt} only now."
-            )
-        return transcript_fmt
+    def use_transcript_cache(self) -> bool:
+        if self.reuse_transcript is None:
+            return not self.promotes
+        return self.reuse_transcript
+
+    @property
+    def transcript_fmt_list(self) -> List[str]:
+        """
+        Requested formats in a stable order, "srt" if none.
+        """
+        return sorted(self.transcript_fmts) or [DEFAULT_TRANSCRIPT_EXT]
 
 
-def get_video_path(uuid: str, ext: str) -> str:
-    return f"{VIDEO_DOWNLOAD_PATH}/{uuid}.{ext}"
+def get_video_path(
+        uuid: str, ext: str, path: str = VIDEO_DOWNLOAD_PATH) -> str:
+    return f"{path}/{uuid}.{ext}"
+
+
+class VideoJob(Job):
+    user: Optional[User] = None
+    video: Optional[Video] = None
+    duration_m: Optional[int] = None
+    # Transcripts came from the transcript cache, nothing to transcribe.
+    reused: bool = False
+    # The video is saved and the user charged for it.
+    charged: bool = False
 
 
 class SingleVideoWorkflow(Workflow[Args]):
-    def __init__(self):
-        super().__init__(WorkflowType.VIDEO, Args)
+    def __init__(
+        self,
+        concurrency: Optional[Mapping[str, int]] = None,
+        download_backend: str = DOWNLOAD_BACKEND,
+        local_max_duration_s: float = LOCAL_MAX_DURATION_S,
+    ):
+        super().__init__(WorkflowType.VIDEO, Args, VideoJob)
+        self.stage_concurrency = {**STAGE_CONCURRENCY, **(concurrency or {})}
+        self.download_backend = download_backend
+        self.local_max_duration_s = local_max_duration_s
+
+    def check_dependencies(self) -> None:
+        """
+        Raise DependencyException at startup, rather than in every job, when
+        what the workflow is configured with isn't installed.
+        """
+        get_backend(self.download_backend)
+        if self.local_max_duration_s > 0:
+            get_engine("local")
+
+    async def serve(self, max_sleep_s: float) -> None:
+        self.check_dependencies()
+        await super().serve(max_sleep_s)
+
+    def stages(self) -> List[Stage]:
+        handlers = {
+            "probe": self._probe,
+            "download": self._download,
+            "prep": self._prepare_audio,
+            "transcribe": self._transcribe,
+            "persist": self._persist,
+            "upload": self._upload,
+        }
+        return [
+            Stage(name, handler, self.stage_concurrency[name])
+            for name, handler in handlers.items()
+        ]
 
     async def _start(self, workflow_id: int, user: User, args: Args):
+        job = VideoJob(id=workflow_id, user_id=user.id, args=args, user=user)
+        for stage in self.stages():
+            job = await stage.handler(job)
+            if job is None:
+                return False
+        return True
+
+    async def on_error(self, job: VideoJob, e: Exception) -> None:
+        if job.video is not None:
+            self.release_video_file(job.video)
+        await super().on_error(job, e)
+
+    async def on_shutdown(self, jobs: List[VideoJob]) -> None:
+        """
+        Requeue the unfinished jobs, except those already charged, which
+        would be charged again. They only missed the upload, so they fail
+        as if it had.
+        """
+        for job in jobs:
+            if job.charged:
+                await self.fail(job.id)
+        await self.requeue([job.id for job in jobs if not job.charged])
+
+    async def enqueue(self, user_id: int, videos: Sequence[Args]) -> int:
+        """
+        Insert TODO workflows for the user's videos in one transaction and
+        wake idle workers. Videos the user already has a video workflow
+        for, from any producer, are skipped. Returns the number inserted.
+        """
+        INSERT_SQL = """
+            INSERT INTO
+                workflow (user_id, create_at, args, type, status)
+            SELECT ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (
+                SELECT
+                    1
+                FROM workflow
+                WHERE user_id = ? AND video_uuid = ? AND type = ?
+            )
+        """
+        if not videos:
+            return 0
+        create_at = int(time.time())
+        workflow_type = self.workflow_type.value
+        async with SQLiteConnectionManager().writer() as conn:
+            try:
+                async with conn.executemany(
+                    INSERT_SQL,
+                    [
+                        (
+                            user_id,
+                            create_at,
+                            args.model_dump_json(),
+                            workflow_type,
+                            Status.TODO.value,
+                            user_id,
+                            args.video_uuid,
+                            workflow_type,
+                        )
+                        for args in videos
+                    ],
+                ) as cursor:
+                    inserted = cursor.rowcount
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        logger.info(
+            f"Enqueued {inserted} of {len(videos)} video workflows "
+            f"for user: {user_id}"
+        )
+        if inserted:
+            WorkNotifier().notify()
+        return inserted
+
+    async def _probe(self, job: VideoJob) -> Optional[VideoJob]:
+        """
+        Check credit, duration and availability from the video info alone,
+        so only videos which will be transcribed get downloaded.
+        """
+        if job.user is None:
+            job.user = await self.get_user(job.id, job.user_id)
+            if job.user is None:
+                return None
+        user, args = job.user, job.args
         logger.info(
             f"Get videos for {args.video_uuid} for user: {user.name}...")
         video = Video(
-            workflow_id=workflow_id,
+            workflow_id=job.id,
             user_id=user.id,
             uuid=args.video_uuid,
         )
-        duration_m = None
-        video = await self.dowload_video(video)
-        if "duration" in video.snippet:
-            duration_m = math.ceil(video.snippet["duration"] / 60.0)
-            if duration_m > user.credit:
+        job.video = video
+        if args.use_transcript_cache and await self.reuse_transcript(
+                video, args):
+            job.reused = True
+        else:
+            await self.probe_video(video)
+            duration_s = video.snippet.get("duration", None)
+            if video.snippet.get("is_live", False) or duration_s is None:
+                logger.warning(
+                    f"Video {video.uuid} is live or not started yet.")
+                await self.fail(job.id)
+                return None
+            if duration_s > MAX_DURATION_M * 60:
+                logger.warning(
+                    f"Video {video.uuid} is {duration_s}s long, "
+                    f"longer than the limit of {MAX_DURATION_M} mins."
+                )
+                await self.fail(job.id)
+                return None
+
+        if video.snippet.get("duration", None) is not None:
+            job.duration_m = math.ceil(video.snippet["duration"] / 60.0)
+            if job.duration_m > user.credit:
                 logger.warning(
                     f"No enough credit. Video {video.uuid} "
-                    f"cost {duration_m} mins of credit "
+                    f"cost {job.duration_m} mins of credit "
                     f"but user {user.id} only has {user.credit} mins."
                 )
-                await self.no_credit(workflow_id)
-                return False
+                await self.no_credit(job.id)
+                return None
 
         logger.info(
-            f"Video {video.uuid} duration is {duration_m} minutes."
+            f"Video {video.uuid} duration is {job.duration_m} minutes."
         )
+        return job
+
+    async def _download(self, job: VideoJob) -> VideoJob:
+        if not job.reused:
+            await self.dowload_video(job.video)
+        return job
+
+    async def _prepare_audio(self, job: VideoJob) -> VideoJob:
+        if job.reused or not TRANSCODE_AUDIO or not audio.has_ffmpeg():
+            return job
+        video = job.video
+        source = video.path
+        # Per workflow, so workers on this host transcoding the same video
+        # never share a file before it is put in the media cache.
+        path = f"{TRANSCODE_PATH}/{video.workflow_id}"
+
+        async def transcode() -> Optional[Tuple[str, Mapping[str, Any]]]:
+            rsp = await TranscodeTask().init().start(
+                TranscodeRequest(path=source, fmt=TRANSCODE_FMT, dir=path)
+            )
+            if rsp.path == source:
+                return None
+            return rsp.path, {"src_bytes": rsp.src_bytes}
 
+        try:
+            entry = await MediaCache().get_or_create(
+                video.uuid, TRANSCODE_FMT, transcode)
+        except Exception as e:
+            logger.warning(
+                f"Failed to transcode {source}, "
+                f"transcribing the original instead. Error: {e}"
+            )
+            return job
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+        if entry is not None:
+            self.release_video_file(video)
+            video.path = entry.path
+        return job
+
+    async def _transcribe(self, job: VideoJob) -> VideoJob:
+        if job.reused:
+            return job
+        args = job.args
         await self.transcript_video(
-            video,
+            job.video,
             args.language,
             args.promotes,
-            args.transcript_fmts,
+            args.transcript_fmt_list,
+            route_engine(
+                job.video.snippet.get("duration", None),
+                self.local_max_duration_s,
+            ),
         )
-
+        self.release_video_file(job.video)
+        return job
+
+    async def _persist(self, job: VideoJob) -> VideoJob:
+        video, user, duration_m = job.video, job.user, job.duration_m
+        if not job.reused:
+            for fmt, content in video.transcript.items():
+                video.set_transcript_id(fmt, await Transcript(
+                    uuid=video.uuid,
+                    language=job.args.language or "",
+                    fmt=fmt,
+                    prompt_hash=prompt_hash(job.args.promotes),
+                    content=content,
+                ).save())
         await video.save()
         # Charge
         if duration_m is None:
             logger.error(
                 f"Can not get duration for video {video.uuid} "
-                f"from workflow {workflow_id} for user: {user.id}"
+                f"from workflow {job.id} for user: {user.id}"
             )
         elif duration_m > 0:
             await user.charge(duration_m)
         elif duration_m <= 0:
             logger.error(
                 f"Duration {duration_m}mins is not expected for "
-                f"video {video.uuid} from workflow {workflow_id} "
+                f"video {video.uuid} from workflow {job.id} "
                 f"for user: {user.id}"
             )
+        job.charged = True
+        return job
 
-        if args.auto_upload:
-            logger.info(f"Going to upload video {video.id}")
+    async def _upload(self, job: VideoJob) -> VideoJob:
+        video = job.video
+        if job.args.auto_upload:
+            logger.info(f"Going to upload video {video.uuid}")
             await self.upload_to_youtube(
-                self,
                 video,
-                args.language,
-                user.credentials,
+                job.args.language,
+                await job.user.fresh_credentials(),
             )
-            logger.info(f"Video {video.id} uploaded.")
+            logger.info(f"Video {video.uuid} uploaded.")
 
         logger.info(f"videos {video.uuid} transcript successed.")
-        await self.done(workflow_id)
-        return True
+        await self.done(job.id)
+        return job
+
+    def release_video_file(self, video: Video) -> None:
+        # The file stays in the media cache until evicted. Forget the path
+        # so it is never released twice, e.g by on_error().
+        MediaCache().release(video.path)
+        video.path = None
 
     async def transcript_video(
         self,
         video: Video,
         language: Optional[str],
         promotes: Optional[str],
-        transcript_fmts: Set[str],
+        transcript_fmts: List[str],
+        engine: str,
     ) -> None:
         transcript_task = TranscriptTask().init()
         try:
-            logger.info(f"language={language}")
+            logger.info(f"language={language}, engine={engine}")
             _ = await transcript_task.start(
                 TranscriptRequest(
                     video=video,
                     language=language,
-                    transcript_fmt=list(transcript_fmts)[0],
+                    transcript_fmts=transcript_fmts,
                     promot=promotes,
+                    engine=engine,
                 )
             )
         except Exception as e:
@@ -162,28 +445,101 @@ class SingleVideoWorkflow(Workflow[Args]):
             )
             raise e
 
+    async def reuse_transcript(self, video: Video, args: Args) -> bool:
+        """
+        Fill the video with cached transcripts and snippet. Returns False,
+        leaving the video untouched, if any of them is missing.
+        """
+        transcripts = []
+        for fmt in args.transcript_fmt_list:
+            transcript = await Transcript.find(
+                video.uuid,
+                args.language,
+                fmt,
+                prompt_hash(args.promotes),
+            )
+            if transcript is None:
+                return False
+            transcripts.append(transcript)
+        snippet = await Video.find_snippet(video.uuid)
+        if snippet is None:
+            return False
+        video.set_snippet(snippet)
+        for transcript in transcripts:
+            video.set_transcript(transcript.fmt, transcript.content)
+            video.set_transcript_id(transcript.fmt, transcript.id)
+        logger.info(
+            f"Reusing transcripts {[t.id for t in transcripts]} "
+            f"for video {video.uuid}"
+        )
+        return True
+
+    async def probe_video(self, video: Video) -> Video:
+        """
+        Set the snippet from the media cache, or from youtube-dl without
+        downloading the video.
+        """
+        cache = MediaCache()
+        entry = await cache.get(video.uuid, SOURCE)
+        if entry is not None:
+            cache.release(entry.path)
+            video.set_snippet(entry.meta)
+            return video
+
+        logger.info(f"Probe video : {video}")
+        try:
+            task = DownloadTask(self.download_backend).init()
+            probe_rsp = await task.start(
+                DownloadRequest(
+                    uuid=video.uuid,
+                    timeout=PROBE_TIMEOUT_S,
+                    skip_download=True,
+                )
+            )
+        except Exception as e:
+            logger.error(
+                f"Failed to probe video: {video.uuid} with error:\n {e}")
+            raise e
+        video.set_snippet({
+            "title": probe_rsp.title,
+            "description": probe_rsp.description,
+            "duration": probe_rsp.duration_s,
+            "is_live": probe_rsp.is_live,
+        })
+        return video
+
     async def dowload_video(self, video: Video) -> Video:
         logger.info(f"Download videos : {video}")
-        download_task = DownloadTask().init()
-        try:
-            download_rsp = await download_task.start(
+        # Per workflow, so concurrent downloads never share a file.
+        path = f"{VIDEO_DOWNLOAD_PATH}/{video.workflow_id}"
+
+        async def download() -> Tuple[str, Mapping[str, Any]]:
+            task = DownloadTask(self.download_backend).init()
+            download_rsp = await task.start(
                 DownloadRequest(
                     uuid=video.uuid,
-                    path=VIDEO_DOWNLOAD_PATH,
+                    path=path,
                     timeout=TIMEOUT_S,
                 )
             )
-            video.path = get_video_path(video.uuid, download_rsp.ext)
-            video.set_snippet({
+            return get_video_path(video.uuid, download_rsp.ext, path), {
                 "title": download_rsp.title,
                 "description": download_rsp.description,
                 "duration": download_rsp.duration_s,
-            })
+            }
+
+        try:
+            entry = await MediaCache().get_or_create(
+                video.uuid, SOURCE, download)
+            video.path = entry.path
+            video.set_snippet(entry.meta)
             logger.info(f"Download success for video: {video}")
         except Exception as e:
             logger.error(
                 f"Failed to download video: {video.uuid} with error:\n {e}")
             raise e
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
 
         return video
 
@@ -200,7 +556,11 @@ class SingleVideoWorkflow(Workflow[Args]):
                 f"not found for video: {video}"
             )
 
-        transcript_path = f"{self._path()}/{self.id}.{DEFAULT_TRANSCRIPT_EXT}"
+        # Per workflow, as workflows for the same video run concurrently.
+        transcript_path = (
+            f"{video._path()}/{video.uuid}.{video.workflow_id}."
+            f"{DEFAULT_TRANSCRIPT_EXT}"
+        )
         try:
             with open(transcript_path, "w", encoding="utf-8") as file:
                 file.write(transcript)
@@ -215,6 +575,11 @@ class SingleVideoWorkflow(Workflow[Args]):
             )
         except Exception as e:
             raise DependencyException from e
+        finally:
+            try:
+                os.remove(transcript_path)
+            except FileNotFoundError:
+                pass
 
 
 def test() -> None:
@@ -235,15 +600,56 @@ def test() -> None:
     logger.info(f"Single video has been done for workflow id: {workflow_id}")
 
 
+async def serve(
+    concurrency: Mapping[str, int],
+    download_backend: str = DOWNLOAD_BACKEND,
+    local_max_duration_s: float = LOCAL_MAX_DURATION_S,
+) -> None:
+    try:
+        await migrate()
+        await SingleVideoWorkflow(
+            concurrency,
+            download_backend,
+            local_max_duration_s,
+        ).serve(MAX_SLEEP_SECONDS)
+    finally:
+        await WorkNotifier().close()
+        await SQLiteConnectionManager().close()
+
+
 def main() -> None:
-    video_workflow = SingleVideoWorkflow()
-    while True:
-        workflow_id = asyncio.run(video_workflow.start())
-        logger.info(
-            f"Single video has been done for workflow id: {workflow_id}. "
-            f"Going to sleep for {SLEEP_SECONDS}s"
+    parser = argparse.ArgumentParser(description="Single video worker.")
+    for stage, concurrency in STAGE_CONCURRENCY.items():
+        parser.add_argument(
+            f"--{stage}-concurrency",
+            type=int,
+            default=concurrency,
+            help=f"Max number of workflows in the {stage} stage at once.",
         )
-        time.sleep(SLEEP_SECONDS)
+    parser.add_argument(
+        "--download-backend",
+        choices=list(BACKENDS),
+        default=DOWNLOAD_BACKEND,
+        help="Run youtube-dl as a subprocess, or as a library in-process.",
+    )
+    parser.add_argument(
+        "--local-max-duration",
+        type=float,
+        default=LOCAL_MAX_DURATION_S,
+        help=(
+            "Transcribe videos up to this many seconds long on this "
+            "machine's CPU, which needs faster-whisper installed."
+        ),
+    )
+    cli_args = vars(parser.parse_args())
+    asyncio.run(serve(
+        {
+            stage: cli_args[f"{stage}_concurrency"]
+            for stage in STAGE_CONCURRENCY
+        },
+        cli_args["download_backend"],
+        cli_args["local_max_duration"],
+    ))
 
 
 # python3 -m workflow.single_video workflow/single_video.py
@@ -1,20 +1,13 @@
 import asyncio
 import logging
 
-from typing import Optional
-from task.transcript_task import (
-    TranscriptTask,
-    TranscriptRequest,
-)
-from task.download_task import (
-    DownloadRequest,
-    DownloadTask
-)
+from typing import Optional, Set
 from task.get_video_task import (
     GetVideoRequest,
     GetVideoTask
 )
 from lib.log import get_logger
+from workflow.single_video import Args, SingleVideoWorkflow
 
 
 logger = get_logger(__file__)
@@ -22,17 +15,31 @@ logger = get_logger(__file__)
 
 MAX_VIDEO = 2
 TIMEOUT_S = 10 * 60
-# trunk-ignore(bandit/B108)
-VIDEO_DOWNLOAD_PATH = "/tmp/workflow/video"
 DEFAULT_TRANSCRIPT_EXT = "srt"
 
 
 class TranscriptChannelWorkflow:
+    """
+    Finds the new videos of a channel and queues a single video workflow
+    for each, so any worker can pick them up.
+    """
 
-    def __init__(self, channel_title: str, user_name: Optional[str]) -> None:
+    def __init__(
+        self,
+        channel_title: str,
+        user_id: int,
+        user_name: Optional[str] = None,
+        auto_upload: bool = True,
+        language: Optional[str] = None,
+        transcript_fmts: Set[str] = {DEFAULT_TRANSCRIPT_EXT},
+    ) -> None:
         self.channel_title = channel_title
         self.max_video = MAX_VIDEO
         self.user_name = user_name
+        self.user_id = user_id
+        self.auto_upload = auto_upload
+        self.language = language
+        self.transcript_fmts = transcript_fmts
         self.videos = []
 
     async def start(self) -> None:
@@ -40,20 +47,37 @@ class TranscriptChannelWorkflow:
         get_video_task = GetVideoTask().init()
         get_video_rsp = await get_video_task.start(GetVideoRequest(
             channel_title=self.channel_title,
-            max_video=self.max_video
+            max_video=self.max_video,
+            user_id=self.user_id,
+            sync=True,
         ))
 
         all_videos = get_video_rsp.videos
 
-        logger.info(f"Download videos : {all_videos}")
-        for video in all_videos:
-            # TODO call signle video workflow.
+        logger.info(f"Queue videos : {all_videos}")
+        await SingleVideoWorkflow().enqueue(
+            self.user_id,
+            [
+                Args(
+                    video_uuid=video.uuid,
+                    auto_upload=self.auto_upload,
+                    language=self.language,
+                    transcript_fmts=self.transcript_fmts,
+                )
+                for video in all_videos
+            ],
+        )
+
+        # Only move the watermark once the new videos are queued.
+        if get_video_rsp.channel_sync is not None:
+            await get_video_rsp.channel_sync.save()
 
 
 # python3 -m workflow.transcript_channel workflow/transcript_channel.py
 # if __name__ == "__main__":
 #     # TODO get args from cli??
 #     workflow = TranscriptChannelWorkflow(
-#         channel_title="索菲亚一斤半Sophia1.5"
+#         channel_title="索菲亚一斤半Sophia1.5",
+#         user_id=3,
 #     )
-#     asyncio.run(workflow.start())
\ No newline at end of file
+#     asyncio.run(workflow.start())
@@ -1,13 +1,18 @@
 from enum import Enum
 from pydantic import BaseModel, ValidationError
-from typing import TypeVar, Generic, Optional, Tuple, Type
+from typing import Any, TypeVar, Generic, List, Optional, Tuple, Type
 
 from lib.aio_sqlite_connection_manager import SQLiteConnectionManager
+from lib.notifier import WorkNotifier
 from lib.user import User
 from lib.log import get_logger
+from workflow.pipeline import Pipeline, Stage
 
 logger = get_logger(__file__)
 
+# First wait when the queue turns empty, doubled up to max_sleep_s.
+MIN_SLEEP_S = 0.5
+
 
 class BaseArgs(BaseModel):
     def __str__(self) -> str:
@@ -40,10 +45,27 @@ class Status(Enum):
 Args = TypeVar("Args", bound=BaseArgs)
 
 
+class Job(BaseModel):
+    """
+    A claimed workflow passed between pipeline stages.
+    """
+    id: int
+    user_id: int
+    args: Any
+
+
 class Workflow(Generic[Args]):
-    def __init__(self, worflow_type: WorkflowType, args: Type[BaseArgs]):
+    def __init__(
+        self,
+        worflow_type: WorkflowType,
+        args: Type[BaseArgs],
+        job: Type[Job] = Job,
+        concurrency: int = 1,
+    ):
         self.args_type = args
         self.workflow_type = worflow_type
+        self.job_type = job
+        self.concurrency = concurrency
 
     async def done(self, id: int) -> None:
         await self.set_status(id, Status.DONE)
@@ -51,13 +73,16 @@ class Workflow(Generic[Args]):
     async def no_credit(self, id: int) -> None:
         await self.set_status(id, Status.NO_CREDIT)
 
+    async def fail(self, id: int) -> None:
+        await self.set_status(id, Status.FAILED)
+
     async def set_status(self, id: int, status: Status) -> None:
         UPDATE_SQL = """
             UPDATE workflow
             SET status = ?
             WHERE id = ?
         """
-        async with SQLiteConnectionManager() as conn:
+        async with SQLiteConnectionManager().writer() as conn:
             logger.info(f"Mark workflow: {id} as {status.name}")
             await conn.execute(
                 UPDATE_SQL,
@@ -65,72 +90,124 @@ class Workflow(Generic[Args]):
             )
             await conn.commit()
 
-    async def claim(self) -> Optional[Tuple[int, int, Args]]:
-        SELECT_SQL = """
-            SELECT
-                id,
-                user_id,
-                args,
-                type
-            FROM
-                workflow
-            WHERE
-                status = ? AND type = ?
-            ORDER BY
-                create_at
-            LIMIT 1
-            """
+    async def requeue(self, ids: List[int]) -> None:
+        """
+        Move claimed workflows back to TODO, for another worker to claim.
+        """
+        UPDATE_SQL = """
+            UPDATE workflow
+            SET status = ?
+            WHERE id = ? AND status = ?
+        """
+        if not ids:
+            return
+        async with SQLiteConnectionManager().writer() as conn:
+            logger.info(f"Requeue workflows: {ids}")
+            await conn.executemany(
+                UPDATE_SQL,
+                [(Status.TODO.value, id, Status.CLAIMED.value) for id in ids],
+            )
+            await conn.commit()
+        WorkNotifier().notify()
+
+    async def on_shutdown(self, jobs: List[Job]) -> None:
+        """
+        Handle the jobs serve() claimed but didn't finish. By default they
+        are requeued.
+        """
+        await self.requeue([job.id for job in jobs])
+
+    async def claim_batch(self, limit: int) -> List[Tuple[int, int, Args]]:
+        """
+        Atomically move up to `limit` of the oldest TODO workflows of this
+        type to CLAIMED in a single statement and return them as
+        (id, user_id, args). Rows whose args can't be parsed are marked as
+        ERROR and left out.
+        """
+        CLAIM_SQL = """
+            UPDATE workflow
+            SET status = ?
+            WHERE id IN (
+                SELECT
+                    id
+                FROM
+                    workflow
+                WHERE
+                    status = ? AND type = ?
+                ORDER BY
+                    create_at
+                LIMIT ?
+            )
+            RETURNING id, user_id, args
+        """
         UPDATE_SQL = """
             UPDATE workflow
             SET status = ?
             WHERE id = ?
         """
-        try:
-            conn = await SQLiteConnectionManager().connect()
-            conn.isolation_level = "EXCLUSIVE"
-            # Select
-            cursor = await conn.execute(
-                SELECT_SQL, (Status.TODO.value, self.workflow_type.value)
+        async with SQLiteConnectionManager().writer() as conn:
+            async with conn.execute(
+                CLAIM_SQL,
+                (
+                    Status.CLAIMED.value,
+                    Status.TODO.value,
+                    self.workflow_type.value,
+                    limit,
+                ),
+            ) as cursor:
+                rows = await cursor.fetchall()
+            await conn.commit()
+
+        if not rows:
+            logger.info(
+                "No pending work left for "
+                f"workflow type: {self.workflow_type.name}"
             )
-            row = await cursor.fetchone()
-            if row:
-                id, user_id, args, type = row
-                # Lock
-                logger.info(f"Locking workflow: {id}")
-                await conn.execute(
-                    UPDATE_SQL,
-                    (Status.LOCKED.value, id),
+            return []
+
+        claims = []
+        errors = []
+        # RETURNING doesn't keep the ORDER BY of the sub query.
+        for id, user_id, args in sorted(rows):
+            try:
+                claims.append(
+                    (id, user_id, self.args_type.from_json(json_str=args))
                 )
-                logger.info(f"Locked workflow: {id}")
-                try:
-                    arg_obj = self.args_type.from_json(json_str=args)
-                except ValidationError as e:
-                    logger.exception(
-                        f"Failed to parse {args}, "
-                        f"mark workflow: {id} as ERROR ",
-                        f"Error stack: {e}"
-                    )
-                    await conn.execute(UPDATE_SQL, (Status.ERROR.value, id))
-
-                # Claim
-                logger.info(f"Claiming workflow: {id}")
-                await conn.execute(UPDATE_SQL, (Status.CLAIMED.value, id))
-            else:
-                logger.info(
-                    "No pending work left for "
-                    f"workflow type: {self.workflow_type.name}"
+                logger.info(f"Claimed workflow: {id}")
+            except ValidationError as e:
+                logger.exception(
+                    f"Failed to parse {args}, "
+                    f"mark workflow: {id} as ERROR. "
+                    f"Error stack: {e}"
                 )
-        except Exception as e:
-            logger.exception(f"Failed with unknown error: \n{e}")
-            # Mark as error.
-            await conn.execute(UPDATE_SQL, (Status.ERROR.value, id))
-        finally:
-            await conn.commit()
-            await SQLiteConnectionManager().close()
+                errors.append((Status.ERROR.value, id))
+
+        if errors:
+            async with SQLiteConnectionManager().writer() as conn:
+                await conn.executemany(UPDATE_SQL, errors)
+                await conn.commit()
+        return claims
 
-        if not row:
+    async def claim(self) -> Optional[Tuple[int, int, Args]]:
+        claims = await self.claim_batch(1)
+        if not claims:
             return None
-        return id, user_id, arg_obj
+        return claims[0]
+
+    async def get_user(self, id: int, user_id: int) -> Optional[User]:
+        user = await User.get_by_id(user_id)
+        if user is None:
+            logger.error(f"User {user_id} not found for workflow: {id}")
+            await self.fail(id)
+        return user
+
+    async def run(self, id: int, user_id: int, args: Args) -> int:
+        logger.info(f"Starting workflow id: {id} with args: {args}")
+        user = await self.get_user(id, user_id)
+        if user is None:
+            return id
+        await self._start(id, user, args)
+        return id
 
     async def start(self) -> Optional[int]:
         out = await self.claim()
@@ -138,8 +215,64 @@ class Workflow(Generic[Args]):
             logger.info("No workflow in TOOD status found, skipping...")
             return None
         id, user_id, args = out
-        logger.info(f"Starting workflow id: {id} with args: {args}")
-        # get user
-        user = await User.get_by_id(user_id)
-        await self._start(id, user, args)
-        return id
+        return await self.run(id, user_id, args)
+
+    def stages(self) -> List[Stage]:
+        """
+        Stages of serve(). By default the whole workflow is one stage.
+        """
+        return [Stage("run", self._run_job, self.concurrency)]
+
+    async def _run_job(self, job: Job) -> None:
+        await self.run(job.id, job.user_id, job.args)
+
+    async def on_error(self, job: Job, e: Exception) -> None:
+        logger.error(f"Workflow: {job.id} failed with error: \n{e}")
+        await self.fail(job.id)
+
+    async def serve(self, max_sleep_s: float) -> None:
+        """
+        Long-lived worker mode. Keep claiming workflows and feed them through
+        a Pipeline of stages() on the current event loop. When there is
+        nothing left to claim, wait for a WorkNotifier wakeup with an
+        exponential backoff from MIN_SLEEP_S up to `max_sleep_s`. Once
+        cancelled, the claimed jobs it didn't finish go to on_shutdown().
+        """
+        pipeline = Pipeline(self.stages(), self.on_error)
+        logger.info(
+            f"Serving {self.workflow_type.name} workflows with stages: "
+            + ", ".join(
+                f"{stage.name}x{stage.concurrency}"
+                for stage in pipeline.stages
+            )
+        )
+        notifier = WorkNotifier()
+        sleep_s = MIN_SLEEP_S
+        # Claimed but not yet submitted to the pipeline.
+        claimed: List[Job] = []
+        pipeline.start()
+        try:
+            while True:
+                free = pipeline.free_slots()
+                if free <= 0:
+                    await pipeline.wait_for_slot()
+                    continue
+                claims = await self.claim_batch(free)
+                if not claims:
+                    if await notifier.wait(sleep_s):
+                        sleep_s = MIN_SLEEP_S
+                    else:
+                        sleep_s = min(sleep_s * 2, max_sleep_s)
+                    continue
+                sleep_s = MIN_SLEEP_S
+                claimed = [
+                    self.job_type(id=id, user_id=user_id, args=args)
+                    for id, user_id, args in claims
+                ]
+                while claimed:
+                    await pipeline.submit(claimed[0])
+                    claimed.pop(0)
+        finally:
+            unfinished = claimed + await pipeline.close()
+            if unfinished:
+                await self.on_shutdown(unfinished)